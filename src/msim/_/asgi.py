@@ -1,8 +1,14 @@
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', '_.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+# Only importable once set up.
+from mortgages.streaming import ASGIHandler  # noqa: E402
+
+
+application = ASGIHandler()
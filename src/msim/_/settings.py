@@ -36,12 +36,14 @@ INSTALLED_APPS = [
     "django.contrib.messages",
     "django.contrib.staticfiles",
 
-    "mortgages",
+    "mortgages.apps.MortgagesConfig",
     "registration",
     "website",
 ]
 
 MIDDLEWARE = [
+    # First, to time everything else.
+    "mortgages.middleware.server_timing_middleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -55,7 +57,9 @@ ROOT_URLCONF = "_.urls"
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        "BACKEND": "mortgages.metrics.DjangoTemplates",
+        # As it would be for Django's own backend.
+        "NAME": "django",
         "DIRS": [],
         "APP_DIRS": True,
         "OPTIONS": {
@@ -86,6 +90,53 @@ databases_template = string.Template(os.getenv(
 DATABASES = json.loads(databases_template.substitute({"BASE_DIR": BASE_DIR}))
 
 
+# Caches
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+CACHES = json.loads(os.getenv(
+    "DJANGO_CACHES",
+    json.dumps({
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+        # Calculated ledgers, keyed by their inputs.  Least recently used
+        # ones are culled once there are `MAX_ENTRIES`.
+        #
+        # With more than one process (several workers, or `runjobs`
+        # alongside the site), use a backend they all share, such as
+        # memcached or the database.  Only then is each mortgage's pointer
+        # to its last ledger kept (see `mortgages.caching`), saving
+        # loading its inputs when nothing's changed.
+        "ledgers": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "ledgers",
+            "TIMEOUT": None,
+            "OPTIONS": {
+                "MAX_ENTRIES": 512,
+            },
+        },
+    }),
+))
+
+
+# Threads that the views calculating ledgers run in under ASGI, apart from
+# the one every other sync view shares.
+LEDGER_WORKERS = json.loads(os.getenv("DJANGO_LEDGER_WORKERS", "4"))
+
+# Processes simulating interest rates share, started when first needed and
+# kept after.  1 runs every simulation in the process asking for it.
+MONTE_CARLO_WORKERS = json.loads(
+    os.getenv("DJANGO_MONTE_CARLO_WORKERS", "2"),
+)
+
+# Seconds after which a job still running is taken to have lost its worker,
+# and is run again by the next one to claim a job.
+JOB_TIMEOUT = json.loads(os.getenv("DJANGO_JOB_TIMEOUT", "3600"))
+
+# What Prometheus has to send as a bearer token to scrape `/metrics`, which
+# is otherwise only for staff.
+METRICS_TOKEN = os.getenv("DJANGO_METRICS_TOKEN", "")
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 AUTH_PASSWORD_VALIDATORS = json.loads(os.getenv(
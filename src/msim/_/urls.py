@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.urls import include, path
 
+from mortgages.views import Metrics
+
 
 urlpatterns = [
     path("admin/", admin.site.urls),
@@ -8,6 +10,7 @@ urlpatterns = [
 
     path("accounts/", include("registration.urls")),
     path("mortgages/", include("mortgages.urls")),
+    path("metrics", Metrics.as_view(), name="metrics"),
 
     path("", include("website.urls")),
 ]
@@ -4,13 +4,17 @@ from .models import (
     ActualInitialPayment,
     ActualThereafterPayment,
     Discrepancy,
+    Job,
     Mortgage,
     Overpayment,
+    RateChange,
 )
 
 
 site.register(ActualInitialPayment)
 site.register(ActualThereafterPayment)
 site.register(Discrepancy)
+site.register(Job)
 site.register(Mortgage)
 site.register(Overpayment)
+site.register(RateChange)
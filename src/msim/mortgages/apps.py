@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+
+
+class MortgagesConfig(AppConfig):
+    name = "mortgages"
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from . import metrics, signals
+
+        signals.connect()
+        connection_created.connect(metrics.install_query_recording)
@@ -0,0 +1,90 @@
+"""
+Finished ledger schedules, cached by what went into them.
+
+Two mortgages with the same inputs (say, a fresh duplicate) share a
+schedule.  Each mortgage also has a pointer to the schedule it last
+produced, so an unchanged mortgage can skip loading its inputs at all;
+`signals` drops the pointer whenever any of those inputs change.
+
+Pointers are only kept in a cache every process shares.  In one that's
+per process, a write in one worker couldn't drop the pointers of the
+others, which would go on serving what it replaced; schedules are still
+found by their inputs there, which can't go stale.
+"""
+import hashlib
+
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from . import engine
+
+
+def get_cache():
+    return caches["ledgers"]
+
+
+def is_shared():
+    return not isinstance(get_cache(), (DummyCache, LocMemCache))
+
+
+def mortgage_key(mortgage_pk):
+    return f"ledger:mortgage:{mortgage_pk}"
+
+
+def content_key(ledger):
+    inputs = (
+        engine.to_pence(ledger.mortgage.amount),
+        sorted(
+            (
+                period.start_month,
+                period.numerator,
+                period.denominator,
+                period.payment,
+                period.default_overpayment,
+            )
+            for period in ledger.pence_periods
+        ),
+        sorted(ledger.pence_overpayments.items()),
+        sorted(ledger.pence_discrepancies.items()),
+    )
+
+    return f"ledger:{hashlib.sha256(repr(inputs).encode()).hexdigest()}"
+
+
+def get_by_mortgage(ledger):
+    """
+    The schedule `ledger`'s mortgage last produced, if nothing's changed
+    since.
+    """
+    if not is_shared():
+        return None
+
+    cache = get_cache()
+
+    key = cache.get(mortgage_key(ledger.mortgage.pk))
+    if key is None:
+        return None
+
+    return cache.get(key)
+
+
+def get_by_content(ledger):
+    return get_cache().get(content_key(ledger))
+
+
+def set_schedule(ledger, schedule):
+    get_cache().set(content_key(ledger), schedule)
+
+
+def set_pointer(ledger):
+    """
+    Point `ledger`'s mortgage at its schedule, which must be what its
+    saved inputs make (see `Ledger._store`).
+    """
+    if is_shared():
+        get_cache().set(mortgage_key(ledger.mortgage.pk), content_key(ledger))
+
+
+def invalidate(mortgage_pk):
+    get_cache().delete(mortgage_key(mortgage_pk))
@@ -0,0 +1,586 @@
+"""
+Integer pence amortisation.
+
+Everything in here works in whole pence and knows nothing about the ORM -
+`models.Ledger` is responsible for turning `Decimal`s into pence on the
+way in and back out again on the way out.
+
+The only rounding is of interest, which `round_div` does exactly: half to
+even, to the nearest penny, which is what `round(balance * rate / 12, 2)`
+does with the default `Decimal` context.
+"""
+from array import array
+from bisect import bisect_right
+from decimal import Decimal
+
+import attr
+
+
+def to_pence(amount):
+    """
+    Sub-penny amounts (which only turn up from forms) are rounded half to
+    even, the same as `round(amount, 2)`.
+    """
+    return round(Decimal(amount) * 100)
+
+
+def from_pence(pence):
+    return Decimal(pence).scaleb(-2)
+
+
+def rate_ratio(interest_rate):
+    """
+    Monthly interest as an exact `(numerator, denominator)` pair.
+    """
+    numerator, denominator = Decimal(interest_rate).as_integer_ratio()
+
+    return numerator, denominator * 12
+
+
+def round_div(numerator, denominator):
+    """
+    `round(numerator / denominator)`, half to even, without going via
+    `Decimal` or `float`.  `denominator` must be positive.
+    """
+    quotient, remainder = divmod(numerator, denominator)
+
+    twice = remainder * 2
+    if twice > denominator or (twice == denominator and quotient % 2):
+        quotient += 1
+
+    return quotient
+
+
+@attr.s
+class PencePeriod:
+    start_month = attr.ib()
+    numerator = attr.ib()
+    denominator = attr.ib()
+    payment = attr.ib()
+    default_overpayment = attr.ib()
+
+    @classmethod
+    def from_period(cls, period):
+        numerator, denominator = rate_ratio(period.interest_rate)
+
+        return cls(
+            start_month=period.start_month,
+            numerator=numerator,
+            denominator=denominator,
+            payment=to_pence(period.payment),
+            default_overpayment=to_pence(period.default_overpayment),
+        )
+
+
+COLUMNS = (
+    "opening_balance",
+    "interest",
+    "payment",
+    "overpayment",
+    "discrepancy",
+    "default_overpayment",
+)
+
+
+def _column():
+    return array("q")
+
+
+@attr.s
+class Schedule:
+    start = attr.ib(default=0)
+
+    opening_balance = attr.ib(factory=_column)
+    interest = attr.ib(factory=_column)
+    payment = attr.ib(factory=_column)
+    overpayment = attr.ib(factory=_column)
+    discrepancy = attr.ib(factory=_column)
+    default_overpayment = attr.ib(factory=_column)
+
+    def __len__(self):
+        return len(self.opening_balance)
+
+    @property
+    def columns(self):
+        return [getattr(self, column) for column in COLUMNS]
+
+    def append(
+        self,
+        opening_balance,
+        interest,
+        payment,
+        overpayment,
+        discrepancy,
+        default_overpayment,
+    ):
+        self.opening_balance.append(opening_balance)
+        self.interest.append(interest)
+        self.payment.append(payment)
+        self.overpayment.append(overpayment)
+        self.discrepancy.append(discrepancy)
+        self.default_overpayment.append(default_overpayment)
+
+    def truncate(self, month):
+        for column in self.columns:
+            del column[month - self.start:]
+
+    @property
+    def balance(self):
+        """
+        The closing balance of the last month, or `None` if there isn't one.
+        """
+        if not self:
+            return None
+
+        return self.closing_balance(len(self) - 1)
+
+    def closing_balance(self, index):
+        return sum([
+            self.opening_balance[index],
+            self.interest[index],
+            self.payment[index],
+            self.overpayment[index],
+            self.discrepancy[index],
+        ])
+
+    @property
+    def cost(self):
+        return sum(self.interest) + sum(self.discrepancy)
+
+
+def _boundaries(start, periods, overpayments, discrepancies):
+    """
+    Months from `start` onwards where something other than the previous
+    month's period applies, in order.
+    """
+    return sorted({
+        month
+        for month in [
+            *(period.start_month for period in periods),
+            *overpayments,
+            *discrepancies,
+        ]
+        if month > start
+    })
+
+
+def simulate(
+    balance,
+    periods,
+    overpayments,
+    discrepancies,
+    start=0,
+    end=None,
+    schedule=None,
+):
+    """
+    Run the mortgage from month `start`, owing `balance` (negative), until
+    it's paid off or month `end` is reached, whichever is sooner.
+
+    `periods` are `PencePeriod`s, `overpayments` and `discrepancies` map
+    month numbers to overridden amounts.  All amounts are in pence.  The
+    months are appended to `schedule` if it's given, which must end just
+    before `start`.
+
+    Months between two boundaries (a period starting, or an override) are
+    identical bar the balance, so they're stepped through in a tight loop
+    without looking anything up; only boundary months and the final month
+    go through the general case.
+    """
+    if schedule is None:
+        schedule = Schedule(start=start)
+
+    if balance == 0:
+        return schedule
+
+    periods = sorted(periods, key=lambda period: period.start_month)
+    start_months = [period.start_month for period in periods]
+    boundaries = _boundaries(start, periods, overpayments, discrepancies)
+    if end is not None:
+        boundaries = [month for month in boundaries if month < end] + [end]
+    boundaries = iter(boundaries)
+
+    month_number = start
+    run_end = next(boundaries, None)
+    period_index = max(bisect_right(start_months, start) - 1, 0)
+    while balance != 0 and month_number != end:
+        if month_number == run_end:
+            run_end = next(boundaries, None)
+
+        while (
+            period_index + 1 < len(periods)
+            and periods[period_index + 1].start_month <= month_number
+        ):
+            period_index += 1
+        period = periods[period_index]
+
+        balance = _step(
+            schedule,
+            balance,
+            period,
+            overpayments.get(month_number, period.default_overpayment),
+            discrepancies.get(month_number, 0),
+        )
+        month_number += 1
+
+        if month_number == run_end:
+            continue
+
+        balance, month_number = _run(
+            schedule,
+            balance,
+            period,
+            month_number,
+            run_end,
+        )
+
+    return schedule
+
+
+def _step(schedule, balance, period, overpayment, discrepancy):
+    interest = round_div(balance * period.numerator, period.denominator)
+    payment = period.payment
+
+    closing_balance = (
+        balance + interest + payment + overpayment + discrepancy
+    )
+
+    # Mirrors `models.LedgerEntry.normalise`.
+    if closing_balance > 0:
+        owed = balance + interest + discrepancy
+        payment = min(payment, abs(owed))
+        overpayment = abs(owed + payment)
+        closing_balance = owed + payment + overpayment
+
+    schedule.append(
+        opening_balance=balance,
+        interest=interest,
+        payment=payment,
+        overpayment=overpayment,
+        discrepancy=discrepancy,
+        default_overpayment=period.default_overpayment,
+    )
+
+    return closing_balance
+
+
+def _run(schedule, balance, period, month_number, run_end):
+    """
+    Step through plain months of `period` until `run_end` (or forever, if
+    `None`), stopping early before the month that pays the mortgage off so
+    that `_step` can normalise it.
+    """
+    numerator = period.numerator
+    denominator = period.denominator
+    payment = period.payment
+    overpayment = period.default_overpayment
+    outgoing = payment + overpayment
+
+    opening_balances = []
+    interests = []
+    while month_number != run_end and balance != 0:
+        quotient, remainder = divmod(balance * numerator, denominator)
+        twice = remainder * 2
+        if twice > denominator or (twice == denominator and quotient % 2):
+            quotient += 1
+
+        closing_balance = balance + quotient + outgoing
+        if closing_balance >= 0:
+            break
+
+        opening_balances.append(balance)
+        interests.append(quotient)
+
+        balance = closing_balance
+        month_number += 1
+
+    count = len(opening_balances)
+    schedule.opening_balance.extend(opening_balances)
+    schedule.interest.extend(interests)
+    schedule.payment.extend(array("q", [payment]) * count)
+    schedule.overpayment.extend(array("q", [overpayment]) * count)
+    schedule.discrepancy.extend(array("q", [0]) * count)
+    schedule.default_overpayment.extend(array("q", [overpayment]) * count)
+
+    return balance, month_number
+
+
+def _cumulative_costs(schedule):
+    """
+    `cumulative[month]` is the cost of every month before `month`.
+    """
+    cumulative = [0]
+    for interest, discrepancy in zip(schedule.interest, schedule.discrepancy):
+        cumulative.append(cumulative[-1] + interest + discrepancy)
+
+    return cumulative
+
+
+def _cost_from(
+    month,
+    schedule,
+    cumulative,
+    periods,
+    overpayments,
+    discrepancies,
+):
+    """
+    The total cost if `schedule` is followed up to `month`, and the given
+    overrides from then on.
+    """
+    if month >= len(schedule):
+        return cumulative[-1]
+
+    tail = simulate(
+        balance=schedule.opening_balance[month],
+        periods=periods,
+        overpayments=overpayments,
+        discrepancies=discrepancies,
+        start=month,
+    )
+
+    return cumulative[month] + tail.cost
+
+
+def _iter_costs_without(
+    schedule,
+    periods,
+    overpayments,
+    discrepancies,
+    which,
+):
+    """
+    How much more the mortgage costs without each of `which` in turn.
+
+    This isn't one pass.  Leaving an override out changes the balance from
+    its month on, and with interest rounded to the penny every month, and
+    the last month cut short, the change doesn't carry through linearly, so
+    neither one run's months nor its costs can be adjusted into another's.
+    Each counterfactual reuses every month before its override and
+    simulates the rest, which is O(overrides * remaining months): about
+    0.2ms each on a 25 year mortgage, or 20ms for 100 overpayments.
+    """
+    cumulative = _cumulative_costs(schedule)
+    cost = cumulative[-1]
+    overrides = {
+        "overpayments": overpayments,
+        "discrepancies": discrepancies,
+    }
+
+    for month in sorted(overrides[which]):
+        without = {**overrides, which: dict(overrides[which])}
+        without[which].pop(month)
+
+        yield month, _cost_from(
+            month,
+            schedule,
+            cumulative,
+            periods,
+            **without,
+        ) - cost
+
+
+def iter_costs_without_overpayments(
+    schedule,
+    periods,
+    overpayments,
+    discrepancies,
+):
+    """
+    As `costs_without_overpayments`, but lazily as `(month, cost)` pairs in
+    month order, so callers can use the early ones before the later ones
+    have been calculated.
+    """
+    return _iter_costs_without(
+        schedule,
+        periods,
+        overpayments,
+        discrepancies,
+        which="overpayments",
+    )
+
+
+def costs_without_overpayments(
+    schedule,
+    periods,
+    overpayments,
+    discrepancies,
+):
+    """
+    How much more the mortgage would have cost without each overpayment
+    (negative for less), keyed by month.
+
+    `schedule` must be the complete schedule, starting from month zero, for
+    the given `periods` and overrides.  Every month before the override is
+    reused as is, so each counterfactual only simulates the months after
+    it.
+    """
+    return dict(iter_costs_without_overpayments(
+        schedule,
+        periods,
+        overpayments,
+        discrepancies,
+    ))
+
+
+def iter_costs_without_discrepancies(
+    schedule,
+    periods,
+    overpayments,
+    discrepancies,
+):
+    return _iter_costs_without(
+        schedule,
+        periods,
+        overpayments,
+        discrepancies,
+        which="discrepancies",
+    )
+
+
+def costs_without_discrepancies(
+    schedule,
+    periods,
+    overpayments,
+    discrepancies,
+):
+    """
+    As `costs_without_overpayments`, but for discrepancies.
+    """
+    return dict(iter_costs_without_discrepancies(
+        schedule,
+        periods,
+        overpayments,
+        discrepancies,
+    ))
+
+
+def _cut_overpayments(schedule, overpayments, amount, month):
+    """
+    Find `amount` by cutting overpayments from `month` backwards, as far as
+    needed.
+
+    Returns the new overpayments, the earliest month cut, and whether it
+    ran out of months to cut.
+    """
+    overpayments = dict(overpayments)
+    no_money = False
+
+    remaining = amount
+    while remaining > 0:
+        overpayment = schedule.overpayment[month]
+        overpayments[month] = max(overpayment - remaining, 0)
+        remaining -= overpayment
+        month -= 1
+
+        if month < 0:
+            no_money = True
+
+            break
+
+    return overpayments, month + 1, no_money
+
+
+def speculation_grid(
+    schedule,
+    periods,
+    overpayments,
+    discrepancies,
+    amounts,
+    months,
+):
+    """
+    What spending each of `amounts` in each of `months` would cost over the
+    whole mortgage, by cutting overpayments to find the money.
+
+    Returns `{(amount, month): (cost, no_money)}`.  `schedule` must be the
+    complete schedule, starting from month zero, for the given `periods`
+    and overrides.  Every cell shares the months before its earliest cut
+    with `schedule`, so only the months after that are simulated.
+    """
+    cumulative = _cumulative_costs(schedule)
+    cost = cumulative[-1]
+
+    grid = {}
+    for month in months:
+        for amount in amounts:
+            cut, earliest, no_money = _cut_overpayments(
+                schedule,
+                overpayments,
+                amount,
+                month,
+            )
+            new_cost = _cost_from(
+                earliest,
+                schedule,
+                cumulative,
+                periods,
+                cut,
+                discrepancies,
+            )
+
+            grid[amount, month] = (cost - new_cost + amount, no_money)
+
+    return grid
+
+
+def optimise_overpayments(
+    schedule,
+    balance,
+    periods,
+    overpayments,
+    discrepancies,
+    budget,
+    caps,
+):
+    """
+    Spread `budget` over overpayments, on top of those `schedule` already
+    makes (from `overpayments`, or each period's default), to make the
+    mortgage as cheap as possible, overpaying at most
+    `caps[period.start_month]` in any month altogether.
+
+    A penny overpaid saves interest on every month after it, so the
+    earlier it's overpaid the more it saves: the cheapest schedule fills
+    each month up to its cap, from the start, until the budget runs out.
+    Only the one schedule needs simulating.
+
+    Returns the overpayments that change, keyed by month, and the
+    resulting schedule, which is what applying them gives.  Overpayments
+    after the mortgage is paid off are left out.
+    """
+    periods = sorted(periods, key=lambda period: period.start_month)
+    start_months = [period.start_month for period in periods]
+
+    optimised = dict(overpayments)
+    changed = []
+    remaining = budget
+    # Overpaying can only bring the end closer, so there's no point looking
+    # past where it ends already.
+    for month in range(len(schedule)):
+        if remaining <= 0:
+            break
+
+        period = periods[max(bisect_right(start_months, month) - 1, 0)]
+        extra = min(
+            caps[period.start_month] - schedule.overpayment[month],
+            remaining,
+        )
+        if extra <= 0:
+            continue
+
+        optimised[month] = schedule.overpayment[month] + extra
+        changed.append(month)
+        remaining -= extra
+
+    schedule = simulate(
+        balance=balance,
+        periods=periods,
+        overpayments=optimised,
+        discrepancies=discrepancies,
+    )
+
+    return {
+        month: schedule.overpayment[month]
+        for month in changed
+        if month < len(schedule)
+    }, schedule
@@ -0,0 +1,100 @@
+"""
+Ledgers as CSV and JSON lines, a row at a time.
+"""
+import csv
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from . import engine
+from .utils import add_months, month_name
+
+
+COLUMNS = (
+    "mortgage",
+    "month_number",
+    "month",
+    "opening_balance",
+    "interest",
+    "payment",
+    "overpayment",
+    "discrepancy",
+    "closing_balance",
+)
+
+CONTENT_TYPES = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+}
+
+
+def iter_ledger_rows(ledger):
+    """
+    A tuple of `COLUMNS` for each month of `ledger`.
+    """
+    ledger.calculate_entries()
+
+    mortgage_pk = ledger.mortgage.pk
+    start_date = ledger.mortgage.start_date
+
+    for month_number, (
+        opening_balance,
+        interest,
+        payment,
+        overpayment,
+        discrepancy,
+        _,
+    ) in enumerate(zip(*ledger.schedule.columns)):
+        yield (
+            mortgage_pk,
+            month_number,
+            month_name(**add_months(
+                start_date.year,
+                start_date.month,
+                month_number,
+            )),
+            *(
+                engine.from_pence(pence)
+                for pence in [
+                    opening_balance,
+                    interest,
+                    payment,
+                    overpayment,
+                    discrepancy,
+                    opening_balance
+                    + interest
+                    + payment
+                    + overpayment
+                    + discrepancy,
+                ]
+            ),
+        )
+
+
+class _Echo:
+    """
+    Enough of a file for `csv.writer` to hand back each line it writes.
+    """
+
+    def write(self, value):
+        return value
+
+
+def as_csv(rows):
+    writer = csv.writer(_Echo())
+
+    yield writer.writerow(COLUMNS)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def as_jsonl(rows):
+    encoder = DjangoJSONEncoder()
+
+    for row in rows:
+        yield encoder.encode(dict(zip(COLUMNS, row))) + "\n"
+
+
+FORMATTERS = {
+    "csv": as_csv,
+    "jsonl": as_jsonl,
+}
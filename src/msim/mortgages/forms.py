@@ -1,6 +1,8 @@
+from decimal import Decimal
+
 from django import forms
 
-from .models import Mortgage
+from .models import Ledger, Mortgage
 
 
 class ActualPaymentSet(forms.Form):
@@ -28,12 +30,13 @@ class ActualPaymentSet(forms.Form):
 class AmountCreateUpdate(forms.Form):
     amount = forms.DecimalField()
     month = forms.IntegerField()
-    mortgage = forms.ModelChoiceField(queryset=Mortgage.objects.all())
+    mortgage = forms.ModelChoiceField(queryset=Mortgage.objects.none())
 
-    def __init__(self, *args, model, **kwargs):
+    def __init__(self, *args, model, user, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.model = model
+        self.fields["mortgage"].queryset = Mortgage.objects.owned_by(user)
 
     def save(self):
         self.model.objects.update_or_create(
@@ -42,16 +45,139 @@ class AmountCreateUpdate(forms.Form):
             defaults={"amount": self.cleaned_data["amount"]},
         )
 
+        # Saving threw away the stored ledger from this month on; put it
+        # back now rather than on the next page load.
+        ledger = Ledger(mortgage=self.cleaned_data["mortgage"])
+        ledger.calculate_entries()
+
+        return ledger
+
+
+class AmountBulkSet(forms.Form):
+    # `{month: amount}`, with an amount of `null` to delete that month's.
+    amounts = forms.JSONField()
+
+    def __init__(self, *args, model, mortgage, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.model = model
+        self.mortgage = mortgage
+
+    def clean_amounts(self):
+        amounts = self.cleaned_data["amounts"]
+        if not isinstance(amounts, dict) or not amounts:
+            raise forms.ValidationError(
+                "Enter an object of months to amounts.",
+            )
+
+        # As `Amount` stores them.
+        month_field = forms.IntegerField(min_value=0, max_value=32767)
+        amount_field = forms.DecimalField(
+            max_digits=9,
+            decimal_places=2,
+            required=False,
+        )
+
+        cleaned = {}
+        errors = []
+        for month, amount in amounts.items():
+            try:
+                month = month_field.clean(month)
+                cleaned[month] = amount_field.clean(amount)
+            except forms.ValidationError as e:
+                errors.extend(
+                    forms.ValidationError(f"{month}: {message}")
+                    for message in e.messages
+                )
+
+        if errors:
+            raise forms.ValidationError(errors)
+
+        return cleaned
+
+    def save(self):
+        amounts = self.cleaned_data["amounts"]
+
+        self.model.objects.bulk_set(self.mortgage, amounts)
+
+        ledger = Ledger(mortgage=self.mortgage)
+        ledger.calculate_entries()
+
+        return ledger
+
 
 class MortgageDuplicate(forms.Form):
+    # Fields a copy can be made with a different value of.
+    VARIABLE_FIELDS = [
+        "amount",
+        "term",
+        "initial_period",
+        "interest_rate_initial",
+        "interest_rate_thereafter",
+        "income",
+        "expenditure",
+        "default_overpayment_initial",
+        "default_overpayment_thereafter",
+    ]
+    MAX_VARIANTS = 20
+
+    vary = forms.ChoiceField(required=False)
+    values = forms.CharField(
+        required=False,
+        help_text="separated by commas, making a copy with each",
+    )
 
     def __init__(self, *args, mortgage, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.mortgage = mortgage
+        self.fields["vary"].choices = [("", "nothing")] + [
+            (name, Mortgage._meta.get_field(name).verbose_name)
+            for name in self.VARIABLE_FIELDS
+        ]
+
+    def clean(self):
+        cleaned_data = super().clean()
+        vary = cleaned_data.get("vary")
+        values = cleaned_data.get("values", "")
+        if not vary:
+            if values:
+                self.add_error("vary", "Choose what the values are for.")
+
+            return cleaned_data
+
+        field = Mortgage._meta.get_field(vary).formfield()
+        variants = []
+        for value in values.split(","):
+            if not value.strip():
+                continue
+
+            try:
+                variants.append({vary: field.clean(value.strip())})
+            except forms.ValidationError as e:
+                for message in e.messages:
+                    self.add_error("values", f"{value.strip()}: {message}")
+
+        if not variants and "values" not in self.errors:
+            self.add_error("values", "Enter at least one value.")
+
+        if len(variants) > self.MAX_VARIANTS:
+            self.add_error(
+                "values",
+                f"Enter at most {self.MAX_VARIANTS} values.",
+            )
+
+        cleaned_data["variants"] = variants
+
+        return cleaned_data
 
     def save(self):
-        return self.mortgage.duplicate()
+        """
+        The copies made, in the order of `values`.
+        """
+        return self.mortgage.duplicate_variants(
+            self.cleaned_data.get("variants") or [{}],
+        )
 
 
 class SpeculateForm(forms.Form):
@@ -62,3 +188,64 @@ class SpeculateForm(forms.Form):
         super().__init__(*args, **kwargs)
 
         self.fields["month"].choices = month_choices
+
+
+class OptimiseForm(forms.Form):
+    budget = forms.DecimalField(min_value=0)
+
+
+class SimulateRatesForm(forms.Form):
+    paths = forms.IntegerField(min_value=1, max_value=10000, initial=1000)
+    drift = forms.DecimalField(
+        min_value=Decimal("-0.1"),
+        max_value=Decimal("0.1"),
+        initial=0,
+        help_text="a year (1% = 0.01)",
+    )
+    volatility = forms.DecimalField(
+        min_value=0,
+        max_value=Decimal("0.5"),
+        initial=Decimal("0.005"),
+        help_text="a year (1% = 0.01)",
+    )
+    seed = forms.IntegerField(initial=0)
+
+
+class SpeculateGridForm(forms.Form):
+    # Each is a column of whole-ledger simulations.
+    MAX_AMOUNTS = 20
+
+    amounts = forms.CharField(help_text="separated by commas")
+
+    def clean_amounts(self):
+        # As `Amount` stores them.
+        amount_field = forms.DecimalField(max_digits=9, decimal_places=2)
+
+        amounts = []
+        errors = []
+        for amount in self.cleaned_data["amounts"].split(","):
+            if not amount.strip():
+                continue
+
+            try:
+                amounts.append(amount_field.clean(amount.strip()))
+            except forms.ValidationError as e:
+                errors.extend(
+                    forms.ValidationError(f"{amount.strip()}: {message}")
+                    for message in e.messages
+                )
+
+        if errors:
+            raise forms.ValidationError(errors)
+
+        if not amounts:
+            raise forms.ValidationError("Enter at least one amount.")
+
+        # Without duplicates, in the order given.
+        amounts = list(dict.fromkeys(amounts))
+        if len(amounts) > self.MAX_AMOUNTS:
+            raise forms.ValidationError(
+                f"Enter at most {self.MAX_AMOUNTS} amounts.",
+            )
+
+        return amounts
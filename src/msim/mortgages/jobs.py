@@ -0,0 +1,226 @@
+"""
+Ledger calculations run as `Job`s, by `manage.py runjobs`.
+
+Each kind of job takes the data of a form, and works its result out from a
+`Ledger` of the job's mortgage as it is when the job runs, reporting its
+progress as it goes.  Results are plain JSON.
+"""
+import hashlib
+import json
+import traceback
+
+from django import forms as django_forms
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+from django.utils import timezone
+
+import attr
+
+from . import caching
+from .forms import OptimiseForm, SimulateRatesForm, SpeculateGridForm
+from .models import Job, Ledger
+
+
+# How many months of a speculation grid to work out between reports of
+# progress.
+GRID_CHUNK_MONTHS = 12
+
+
+@attr.s
+class Kind:
+    form_class = attr.ib()
+    # `run(ledger, cleaned_data, progress)`, where `progress` takes the
+    # fraction done so far.
+    run = attr.ib()
+
+
+def speculation_grid(ledger, data, progress):
+    months = [month for month, _ in ledger.month_choices]
+
+    cells = []
+    for start in range(0, len(months), GRID_CHUNK_MONTHS):
+        chunk = months[start:start + GRID_CHUNK_MONTHS]
+        grid = ledger.speculation_grid(amounts=data["amounts"], months=chunk)
+        cells.extend(
+            {
+                "amount": amount,
+                "month": month,
+                "cost": cost,
+                "no_money": no_money,
+            }
+            for (amount, month), (cost, no_money) in grid.items()
+        )
+        progress((start + len(chunk)) / len(months))
+
+    return cells
+
+
+def costs_without_overpayments(ledger, data, progress):
+    overpayments = ledger.overpayments
+
+    costs = []
+    for month, cost in ledger.iter_costs_without_overpayments():
+        costs.append({"month": month, "cost": cost})
+        progress(len(costs) / len(overpayments))
+
+    return costs
+
+
+def costs_without_discrepancies(ledger, data, progress):
+    discrepancies = ledger.discrepancies
+
+    costs = []
+    for month, cost in ledger.iter_costs_without_discrepancies():
+        costs.append({"month": month, "cost": cost})
+        progress(len(costs) / len(discrepancies))
+
+    return costs
+
+
+def simulate_rates(ledger, data, progress):
+    return ledger.simulate_rates(
+        paths=data["paths"],
+        drift=float(data["drift"]),
+        volatility=float(data["volatility"]),
+        seed=data["seed"],
+    )
+
+
+def optimise(ledger, data, progress):
+    overpayments, cost = ledger.optimise_overpayments(data["budget"])
+
+    return {
+        "overpayments": [
+            {"month": month, "amount": amount}
+            for month, amount in sorted(overpayments.items())
+        ],
+        "cost": cost,
+    }
+
+
+KINDS = {
+    "speculation_grid": Kind(
+        form_class=SpeculateGridForm,
+        run=speculation_grid,
+    ),
+    "costs_without_overpayments": Kind(
+        form_class=django_forms.Form,
+        run=costs_without_overpayments,
+    ),
+    "costs_without_discrepancies": Kind(
+        form_class=django_forms.Form,
+        run=costs_without_discrepancies,
+    ),
+    "simulate_rates": Kind(form_class=SimulateRatesForm, run=simulate_rates),
+    "optimise": Kind(form_class=OptimiseForm, run=optimise),
+}
+
+
+def parameters(form):
+    """
+    What was submitted to `form`, to be submitted to it again when the job
+    runs.
+    """
+    return {name: form.data.get(name) for name in form.fields}
+
+
+def job_key(ledger, kind, parameters):
+    mortgage = ledger.mortgage
+    inputs = (
+        kind,
+        sorted(parameters.items()),
+        caching.content_key(ledger),
+        # What isn't in the ledger's own inputs.
+        mortgage.start_date,
+        mortgage.term,
+        mortgage.initial_period,
+        mortgage.income,
+        mortgage.expenditure,
+    )
+
+    return hashlib.sha256(repr(inputs).encode()).hexdigest()
+
+
+def submit(mortgage, kind, parameters):
+    """
+    A job working out `kind` for `mortgage`, reusing one for the same
+    inputs if there is one that hasn't failed.  One left running by a
+    worker that's gone is run again by the next (see `JobManager.claim`).
+    """
+    key = job_key(Ledger(mortgage=mortgage), kind, parameters)
+
+    job = (
+        Job.objects
+        .filter(mortgage=mortgage, key=key)
+        .exclude(status=Job.FAILED)
+        .order_by("-created")
+        .first()
+    )
+    if job is not None:
+        return job
+
+    return Job.objects.create(
+        mortgage=mortgage,
+        kind=kind,
+        parameters=parameters,
+        key=key,
+    )
+
+
+def run(job):
+    """
+    Run `job`, which has already been claimed, storing its result or what
+    went wrong.
+    """
+    def progress(fraction):
+        Job.objects.filter(pk=job.pk).update(progress=fraction)
+
+    try:
+        kind = KINDS[job.kind]
+        ledger = Ledger(mortgage=job.mortgage)
+
+        form = kind.form_class(job.parameters)
+        if not form.is_valid():
+            raise ValueError(f"Invalid parameters: {form.errors.as_json()}")
+
+        # Results are stored as they were when encoded, which is how
+        # they're served.
+        result = json.loads(json.dumps(
+            kind.run(ledger, form.cleaned_data, progress),
+            cls=DjangoJSONEncoder,
+        ))
+    except Exception:
+        job.status = Job.FAILED
+        job.error = traceback.format_exc()
+        # Leaving the progress it got to.
+        fields = ["status", "error"]
+    else:
+        job.status = Job.DONE
+        job.progress = 1
+        job.result = result
+        # The mortgage may have changed since the job was submitted, in
+        # which case this is the result for what it is now.
+        job.key = job_key(ledger, job.kind, job.parameters)
+        fields = ["status", "progress", "result", "key"]
+
+    job.finished = timezone.now()
+    job.save(update_fields=[*fields, "finished"])
+
+
+def run_pending(once=False, sleep=None):
+    """
+    Run pending jobs, oldest first.  Returns when there are none left if
+    `once`, or waits for more otherwise, calling `sleep()` in between.
+    """
+    while True:
+        close_old_connections()
+
+        job = Job.objects.claim()
+        if job is None:
+            if once:
+                return
+
+            sleep()
+            continue
+
+        run(job)
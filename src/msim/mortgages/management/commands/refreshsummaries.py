@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from mortgages.models import Mortgage
+
+
+class Command(BaseCommand):
+    help = "Recalculate the stored payoff date and costs of every mortgage."
+
+    def handle(self, *args, **options):
+        for mortgage in Mortgage.objects.iterator():
+            mortgage.refresh_summary()
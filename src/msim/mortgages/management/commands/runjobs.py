@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mortgages import jobs
+
+
+class Command(BaseCommand):
+    help = "Run queued ledger calculations as they're submitted."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="exit once there are no jobs left, rather than waiting",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1,
+            help="seconds between checks for new jobs",
+        )
+
+    def handle(self, *args, **options):
+        jobs.run_pending(
+            once=options["once"],
+            sleep=lambda: time.sleep(options["interval"]),
+        )
@@ -0,0 +1,256 @@
+"""
+Where each request's time goes: queries, calculating ledgers and
+rendering.
+
+`server_timing_middleware` starts `recording` for each request, sends the
+breakdown back in a `Server-Timing` header and adds it to `registry`, which
+`/metrics` serves to Prometheus.  Everything else reports through `timing`
+and `count`, which do nothing outside of a request.
+
+The registry is per process, so each worker serves its own numbers.
+"""
+import bisect
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+
+from django.template.backends import django
+
+import attr
+
+
+_timings = contextvars.ContextVar("timings", default=None)
+
+# Seconds, as Prometheus' client libraries default to.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+@attr.s
+class Timings:
+    """
+    Seconds spent on each kind of thing in a request.  Time spent in one
+    thing while timing another only counts towards the inner one.
+    """
+    db = attr.ib(default=0.0)
+    ledger = attr.ib(default=0.0)
+    render = attr.ib(default=0.0)
+    queries = attr.ib(default=0)
+    counterfactuals = attr.ib(default=0)
+    # `[name, started]` of everything being timed, innermost last.
+    running = attr.ib(factory=list, init=False, repr=False)
+
+    @contextmanager
+    def timing(self, name):
+        now = time.perf_counter()
+        if self.running:
+            self._add_running(now)
+
+        current = [name, now]
+        self.running.append(current)
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self._add_running(now)
+            self.running.pop()
+
+            if self.running:
+                self.running[-1][1] = now
+
+    def _add_running(self, now):
+        name, started = self.running[-1]
+        setattr(self, name, getattr(self, name) + now - started)
+        self.running[-1][1] = now
+
+    def as_header(self, total):
+        def milliseconds(seconds):
+            return f"{seconds * 1000:.1f}"
+
+        return ", ".join([
+            f'db;dur={milliseconds(self.db)};desc="{self.queries} queries"',
+            f"ledger;dur={milliseconds(self.ledger)}",
+            f'counterfactuals;desc="{self.counterfactuals}"',
+            f"render;dur={milliseconds(self.render)}",
+            f"total;dur={milliseconds(total)}",
+        ])
+
+
+@contextmanager
+def recording():
+    """
+    Record into a new `Timings` for everything run from within, including
+    in threads handed this context.
+    """
+    timings = Timings()
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+@contextmanager
+def timing(name):
+    """
+    Add the time spent within to the current request's `name`.
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+
+        return
+
+    with timings.timing(name):
+        yield
+
+
+def count(name, amount=1):
+    timings = _timings.get()
+    if timings is not None:
+        setattr(timings, name, getattr(timings, name) + amount)
+
+
+class Template(django.Template):
+    """
+    Django's own template, timing each render.
+    """
+
+    def render(self, context=None, request=None):
+        with timing("render"):
+            return super().render(context, request)
+
+
+class DjangoTemplates(django.DjangoTemplates):
+    """
+    Django's own templates, timing each render.
+    """
+
+    def from_string(self, template_code):
+        return Template(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return Template(super().get_template(template_name).template, self)
+
+
+def record_query(execute, sql, params, many, context):
+    timings = _timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+
+    timings.queries += 1
+    with timings.timing("db"):
+        return execute(sql, params, many, context)
+
+
+def install_query_recording(sender, connection, **kwargs):
+    """
+    Record the queries of every connection as it's made.
+    """
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@attr.s
+class ViewStats:
+    buckets = attr.ib(factory=lambda: [0] * len(BUCKETS))
+    count = attr.ib(default=0)
+    seconds = attr.ib(default=0.0)
+    db = attr.ib(default=0.0)
+    queries = attr.ib(default=0)
+    ledger = attr.ib(default=0.0)
+    counterfactuals = attr.ib(default=0)
+    render = attr.ib(default=0.0)
+
+
+# `(name, description, ViewStats attribute)` of each counter.
+TOTALS = [
+    ("msim_db_seconds_total", "Time spent in queries.", "db"),
+    ("msim_db_queries_total", "Queries made.", "queries"),
+    ("msim_ledger_seconds_total", "Time spent calculating ledgers.", "ledger"),
+    (
+        "msim_counterfactuals_total",
+        "Counterfactual costs calculated.",
+        "counterfactuals",
+    ),
+    ("msim_render_seconds_total", "Time spent rendering.", "render"),
+]
+
+
+class Registry:
+    """
+    Totals of every request's `Timings`, by view.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+
+    def observe(self, view, seconds, timings):
+        with self._lock:
+            stats = self._views.setdefault(view, ViewStats())
+
+            # Buckets are cumulative; each counts everything up to it.
+            for index in range(
+                bisect.bisect_left(BUCKETS, seconds),
+                len(BUCKETS),
+            ):
+                stats.buckets[index] += 1
+
+            stats.count += 1
+            stats.seconds += seconds
+            for _, _, attribute in TOTALS:
+                setattr(
+                    stats,
+                    attribute,
+                    getattr(stats, attribute) + getattr(timings, attribute),
+                )
+
+    def clear(self):
+        with self._lock:
+            self._views.clear()
+
+    def as_text(self):
+        """
+        In Prometheus' text exposition format.
+        """
+        with self._lock:
+            views = sorted(
+                (view, attr.evolve(stats, buckets=list(stats.buckets)))
+                for view, stats in self._views.items()
+            )
+
+        lines = [
+            "# HELP msim_request_duration_seconds Time taken to respond.",
+            "# TYPE msim_request_duration_seconds histogram",
+        ]
+        for view, stats in views:
+            for bound, bucket in zip(BUCKETS, stats.buckets):
+                lines.append(
+                    "msim_request_duration_seconds_bucket"
+                    f'{{view="{view}",le="{bound}"}} {bucket}'
+                )
+
+            lines.extend([
+                "msim_request_duration_seconds_bucket"
+                f'{{view="{view}",le="+Inf"}} {stats.count}',
+                "msim_request_duration_seconds_sum"
+                f'{{view="{view}"}} {stats.seconds}',
+                "msim_request_duration_seconds_count"
+                f'{{view="{view}"}} {stats.count}',
+            ])
+
+        for name, description, attribute in TOTALS:
+            lines.extend([
+                f"# HELP {name} {description}",
+                f"# TYPE {name} counter",
+            ])
+            lines.extend(
+                f'{name}{{view="{view}"}} {getattr(stats, attribute)}'
+                for view, stats in views
+            )
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
@@ -0,0 +1,56 @@
+import asyncio
+import time
+
+from django.utils.decorators import sync_and_async_middleware
+
+from . import metrics
+
+
+def view_name(request):
+    """
+    What to file `request` under in `metrics.registry`: the name of the
+    mortgages URL it went to, or "other".
+    """
+    match = getattr(request, "resolver_match", None)
+    if match is None or "mortgages" not in match.namespaces:
+        return "other"
+
+    return match.view_name
+
+
+@sync_and_async_middleware
+def server_timing_middleware(get_response):
+    """
+    Record where each request's time went (see `metrics`), send it back in
+    a `Server-Timing` header and add it to `metrics.registry`.
+
+    Streamed responses are timed up to their first byte.
+
+    Works either way round, so as not to make Django hand async views back
+    to the one thread sync views run in.
+    """
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = time.perf_counter()
+            with metrics.recording() as timings:
+                response = await get_response(request)
+
+            return finish(request, response, timings, start)
+    else:
+        def middleware(request):
+            start = time.perf_counter()
+            with metrics.recording() as timings:
+                response = get_response(request)
+
+            return finish(request, response, timings, start)
+
+    return middleware
+
+
+def finish(request, response, timings, start):
+    total = time.perf_counter() - start
+
+    response["Server-Timing"] = timings.as_header(total)
+    metrics.registry.observe(view_name(request), total, timings)
+
+    return response
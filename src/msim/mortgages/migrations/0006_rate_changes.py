@@ -0,0 +1,72 @@
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mortgages", "0005_remove_janky_date_fields"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RateChange",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("start_month", models.PositiveSmallIntegerField()),
+                (
+                    "interest_rate",
+                    models.DecimalField(
+                        decimal_places=5,
+                        help_text="(1% = 0.01)",
+                        max_digits=5,
+                    ),
+                ),
+                (
+                    "payment",
+                    models.DecimalField(
+                        blank=True,
+                        decimal_places=2,
+                        help_text="calculated automatically if left blank",
+                        max_digits=9,
+                        validators=[
+                            django.core.validators.MinValueValidator(0),
+                        ],
+                    ),
+                ),
+                (
+                    "default_overpayment",
+                    models.DecimalField(
+                        blank=True,
+                        decimal_places=2,
+                        help_text="calculated automatically if left blank",
+                        max_digits=9,
+                        validators=[
+                            django.core.validators.MinValueValidator(0),
+                        ],
+                    ),
+                ),
+                (
+                    "mortgage",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="ratechanges",
+                        to="mortgages.mortgage",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ("start_month",),
+                "unique_together": {("mortgage", "start_month")},
+            },
+        ),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mortgages", "0006_rate_changes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LedgerMonth",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("month_number", models.PositiveSmallIntegerField()),
+                ("opening_balance", models.BigIntegerField()),
+                ("interest", models.BigIntegerField()),
+                ("payment", models.BigIntegerField()),
+                ("overpayment", models.BigIntegerField()),
+                ("discrepancy", models.BigIntegerField()),
+                ("default_overpayment", models.BigIntegerField()),
+                (
+                    "mortgage",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="ledgermonths",
+                        to="mortgages.mortgage",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("mortgage", "month_number")},
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mortgages", "0007_ledger_months"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mortgage",
+            name="payoff_date",
+            field=models.DateField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="mortgage",
+            name="total_cost",
+            field=models.DecimalField(
+                decimal_places=2,
+                editable=False,
+                max_digits=11,
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="mortgage",
+            name="total_interest",
+            field=models.DecimalField(
+                decimal_places=2,
+                editable=False,
+                max_digits=11,
+                null=True,
+            ),
+        ),
+    ]
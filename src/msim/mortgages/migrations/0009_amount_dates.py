@@ -0,0 +1,69 @@
+from calendar import monthrange
+import datetime
+
+from django.db import migrations, models
+
+
+def set_dates(apps, schema_editor):
+    for name in ["Discrepancy", "Overpayment"]:
+        Amount = apps.get_model("mortgages", name)
+
+        amounts = list(Amount.objects.select_related("mortgage"))
+        for amount in amounts:
+            start_date = amount.mortgage.start_date
+            month_index = start_date.month - 1 + amount.month
+            year = start_date.year + month_index // 12
+            month = month_index % 12 + 1
+
+            amount.date = datetime.date(
+                year=year,
+                month=month,
+                day=min(start_date.day, monthrange(year, month)[1]),
+            )
+
+        Amount.objects.bulk_update(amounts, ["date"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mortgages", "0008_mortgage_summary"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="discrepancy",
+            name="date",
+            field=models.DateField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="overpayment",
+            name="date",
+            field=models.DateField(editable=False, null=True),
+        ),
+        migrations.RunPython(set_dates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="discrepancy",
+            name="date",
+            field=models.DateField(editable=False),
+        ),
+        migrations.AlterField(
+            model_name="overpayment",
+            name="date",
+            field=models.DateField(editable=False),
+        ),
+        migrations.AddIndex(
+            model_name="discrepancy",
+            index=models.Index(
+                fields=["mortgage", "date", "amount"],
+                name="mortgages_discrepancy_date",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="overpayment",
+            index=models.Index(
+                fields=["mortgage", "date", "amount"],
+                name="mortgages_overpayment_date",
+            ),
+        ),
+    ]
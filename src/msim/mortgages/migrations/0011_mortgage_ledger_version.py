@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mortgages", "0010_jobs"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mortgage",
+            name="ledger_version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
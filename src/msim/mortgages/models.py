@@ -1,17 +1,33 @@
+from bisect import bisect_right
+from calendar import monthrange
+from collections import defaultdict
+from collections.abc import Sequence
+import datetime
 from decimal import Decimal
+from itertools import groupby
+from operator import itemgetter
+import weakref
 
 from django.conf import settings
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
-from django.db.models import F
-from django.db.models.expressions import RawSQL
+from django.db import connections, models, transaction
+from django.db.models import (
+    ExpressionWrapper,
+    F,
+    OuterRef,
+    Q,
+    Subquery,
+    Value,
+)
+from django.db.models.functions import ExtractMonth, ExtractYear
 from django.template.loader import render_to_string
 from django.urls import reverse
 from django.utils import timezone
 
 import attr
 
-from .utils import payment
+from . import caching, engine, metrics, montecarlo
+from .utils import add_months, add_months_to_date, month_name, payment
 
 
 class MortgageQuerySet(models.QuerySet):
@@ -19,9 +35,144 @@ class MortgageQuerySet(models.QuerySet):
     def owned_by(self, user):
         return self.filter(owner=user)
 
+    def with_next_month_balance(self):
+        """
+        Annotate the opening balance of next calendar month, from the
+        stored `LedgerMonth`s.  `None` before the mortgage starts or after
+        it's paid off.
+        """
+        today = timezone.now().date()
+        next_month = add_months(today.year, today.month, 1)
+
+        return self.annotate(next_month_number=ExpressionWrapper(
+            (next_month["year"] - ExtractYear("start_date")) * 12
+            + next_month["month"] - ExtractMonth("start_date"),
+            output_field=models.IntegerField(),
+        )).annotate(next_month_balance=Subquery(
+            LedgerMonth.objects
+            .filter(
+                mortgage=OuterRef("pk"),
+                month_number=OuterRef("next_month_number"),
+            )
+            .annotate(balance=ExpressionWrapper(
+                F("opening_balance") * Value(Decimal("0.01")),
+                output_field=models.DecimalField(
+                    max_digits=11,
+                    decimal_places=2,
+                ),
+            ))
+            .values("balance")[:1],
+        ))
+
+    def iter_ledgers(self, chunk_size=100):
+        """
+        A `Ledger` for each mortgage, in `pk` order.
+
+        The mortgages and all of their inputs come through two server-side
+        cursors, walked side by side, so only one mortgage's worth is held
+        at a time however many there are.  The ledgers only read what's
+        been stored, rather than locking each mortgage to store more.
+        """
+        mortgages = self.order_by("pk").iterator(chunk_size=chunk_size)
+        groups = groupby(
+            ledger_input_rows(mortgage__in=self.values("pk"))
+            .order_by("row_mortgage")
+            .iterator(chunk_size=chunk_size),
+            key=itemgetter(0),
+        )
+
+        mortgage_pk, rows = next(groups, (None, ()))
+        for mortgage in mortgages:
+            mortgage_rows = ()
+            if mortgage_pk == mortgage.pk:
+                mortgage_rows = rows
+                mortgage_pk, rows = next(groups, (None, ()))
+
+            ledger = Ledger(mortgage=mortgage, store=False)
+            ledger.set_inputs(mortgage.ledger_inputs(mortgage_rows))
+
+            yield ledger
+
 
 class MortgageManager(models.Manager.from_queryset(MortgageQuerySet)):
-    pass
+
+    def change_ledger(self, mortgage_pk):
+        """
+        Move the mortgage's `ledger_version` on, locking it until the
+        transaction's done.  Whether there was one.
+        """
+        return bool(
+            self
+            .filter(pk=mortgage_pk)
+            .update(ledger_version=F("ledger_version") + 1)
+        )
+
+
+def ledger_input_rows(**filters):
+    """
+    The rate changes, overrides and actual payments of the mortgages
+    matching `filters`, as one query of
+    `(mortgage_pk, kind, month, pk, amount, interest_rate,
+    default_overpayment)` rows.
+    """
+    null = Value(None, output_field=models.DecimalField())
+
+    def rows(
+        queryset,
+        kind,
+        month=F("month"),
+        amount=F("amount"),
+        interest_rate=null,
+        default_overpayment=null,
+    ):
+        # All annotations, so the columns line up in the same order in
+        # every part of the union.
+        return (
+            queryset
+            .filter(**filters)
+            .order_by()
+            .annotate(
+                row_mortgage=F("mortgage_id"),
+                row_kind=Value(kind, output_field=models.CharField()),
+                row_month=month,
+                row_pk=F("pk"),
+                row_amount=amount,
+                row_interest_rate=interest_rate,
+                row_default_overpayment=default_overpayment,
+            )
+            .values_list(
+                "row_mortgage",
+                "row_kind",
+                "row_month",
+                "row_pk",
+                "row_amount",
+                "row_interest_rate",
+                "row_default_overpayment",
+            )
+        )
+
+    first_month = Value(0, output_field=models.IntegerField())
+
+    # Rate changes go first, as the first query decides how every column
+    # is converted.
+    return rows(
+        RateChange.objects,
+        "rate_change",
+        month=F("start_month"),
+        amount=F("payment"),
+        interest_rate=F("interest_rate"),
+        default_overpayment=F("default_overpayment"),
+    ).union(
+        rows(Overpayment.objects, "overpayment"),
+        rows(Discrepancy.objects, "discrepancy"),
+        rows(ActualInitialPayment.objects, "initial", month=first_month),
+        rows(
+            ActualThereafterPayment.objects,
+            "thereafter",
+            month=first_month,
+        ),
+        all=True,
+    )
 
 
 def between(lower, upper):
@@ -75,6 +226,27 @@ class Mortgage(models.Model):
         help_text="calculated automatically if left blank",
     )
 
+    # Kept up to date by `refresh_summary`, so lists don't have to
+    # calculate ledgers.
+    payoff_date = models.DateField(null=True, editable=False)
+    total_cost = models.DecimalField(
+        max_digits=11,
+        decimal_places=2,
+        null=True,
+        editable=False,
+    )
+    total_interest = models.DecimalField(
+        max_digits=11,
+        decimal_places=2,
+        null=True,
+        editable=False,
+    )
+
+    # Moved on by `signals` whenever anything going into the ledger
+    # changes, so what was calculated from an instance is only stored if
+    # it's still the latest (see `Ledger._store`).
+    ledger_version = models.PositiveIntegerField(default=0, editable=False)
+
     objects = MortgageManager()
 
     def __str__(self):
@@ -86,10 +258,44 @@ class Mortgage(models.Model):
     def get_absolute_url(self):
         return reverse("mortgages:detail", kwargs={"pk": self.pk})
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_start_date = instance.__dict__.get("start_date")
+
+        return instance
+
     def save(self, *args, **kwargs):
         self.ensure_defaults()
 
-        return super().save(*args, **kwargs)
+        if not self._state.adding and not args and not kwargs:
+            # Not `ledger_version`, which may have moved on since this was
+            # read, and going back would let stale ledgers be stored.
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != "ledger_version"
+            ]
+
+        super().save(*args, **kwargs)
+
+        loaded_start_date = getattr(self, "_loaded_start_date", None)
+        if loaded_start_date not in {None, self.start_date}:
+            self.move_amount_dates()
+
+        self._loaded_start_date = self.start_date
+
+    def move_amount_dates(self):
+        """
+        Bring the dates of this mortgage's overrides in line with its
+        `start_date`.
+        """
+        for model in [Overpayment, Discrepancy]:
+            amounts = list(model.objects.for_mortgage(self).only("month"))
+            for amount in amounts:
+                amount.date = add_months_to_date(self.start_date, amount.month)
+
+            model.objects.bulk_update(amounts, ["date"])
 
     @property
     def default_payment_initial(self):
@@ -128,58 +334,208 @@ class Mortgage(models.Model):
         try:
             payment_initial = self.actualinitialpayment.amount
         except ActualInitialPayment.DoesNotExist:
-            payment_initial = self.default_payment_initial
+            payment_initial = None
 
         try:
             payment_thereafter = self.actualthereafterpayment.amount
         except ActualThereafterPayment.DoesNotExist:
-            payment_thereafter = self.default_payment_thereafter
-
-        return Periods(periods=[
-            Period(
-                interest_rate=self.interest_rate_initial,
-                payment=payment_initial,
-                default_overpayment=self.default_overpayment_initial,
-                start_month=0,
-            ),
-            Period(
-                interest_rate=self.interest_rate_thereafter,
-                payment=payment_thereafter,
-                default_overpayment=self.default_overpayment_thereafter,
-                start_month=self.initial_period,
-            ),
-        ])
-
-    def duplicate(self):
-        try:
-            initial = self.actualinitialpayment
-        except ActualInitialPayment.DoesNotExist:
-            initial = None
+            payment_thereafter = None
+
+        return self._periods(
+            payment_initial=payment_initial,
+            payment_thereafter=payment_thereafter,
+            rate_changes=[
+                rate_change.as_period()
+                for rate_change in self.ratechanges.all()
+            ],
+        )
 
-        try:
-            thereafter = self.actualthereafterpayment
-        except ActualThereafterPayment.DoesNotExist:
-            thereafter = None
+    def _periods(self, payment_initial, payment_thereafter, rate_changes):
+        if payment_initial is None:
+            payment_initial = self.default_payment_initial
 
-        overpayments = Overpayment.objects.for_mortgage(self)
-        discrepancies = Discrepancy.objects.for_mortgage(self)
+        if payment_thereafter is None:
+            payment_thereafter = self.default_payment_thereafter
 
-        self.pk = None
-        self.save()
+        # With an `initial_period` of 0 there is no initial period at all;
+        # the thereafter period, at the same start month, replaces it.
+        periods = {
+            period.start_month: period
+            for period in [
+                Period(
+                    interest_rate=self.interest_rate_initial,
+                    payment=payment_initial,
+                    default_overpayment=self.default_overpayment_initial,
+                    start_month=0,
+                ),
+                Period(
+                    interest_rate=self.interest_rate_thereafter,
+                    payment=payment_thereafter,
+                    default_overpayment=self.default_overpayment_thereafter,
+                    start_month=self.initial_period,
+                ),
+            ]
+        }
 
-        if initial is not None:
-            initial.duplicate_for(self)
+        # Rate changes on top of the initial and thereafter rates, for
+        # trackers and stepped products.
+        for rate_change in rate_changes:
+            periods[rate_change.start_month] = rate_change
+
+        return Periods(periods=list(periods.values()))
+
+    def load_ledger_inputs(self):
+        """
+        Everything `Ledger` needs besides the mortgage itself, in one
+        query of plain rows rather than a query per relation of model
+        instances.
+        """
+        return self.ledger_inputs(ledger_input_rows(mortgage=self))
+
+    def ledger_inputs(self, rows):
+        """
+        Build this mortgage's `LedgerInputs` from its `ledger_input_rows`.
+        """
+        inputs = LedgerInputs()
+        payments = {}
+        rate_changes = []
+        for (
+            mortgage_pk,
+            kind,
+            month,
+            pk,
+            amount,
+            interest_rate,
+            default_overpayment,
+        ) in rows:
+            if kind == "rate_change":
+                rate_changes.append(Period(
+                    interest_rate=interest_rate,
+                    payment=amount,
+                    default_overpayment=default_overpayment,
+                    start_month=month,
+                ))
+            elif kind == "overpayment":
+                inputs.overpayments[month] = AmountRow(pk=pk, amount=amount)
+            elif kind == "discrepancy":
+                inputs.discrepancies[month] = AmountRow(pk=pk, amount=amount)
+            else:
+                payments[kind] = amount
+
+        inputs.periods = self._periods(
+            payment_initial=payments.get("initial"),
+            payment_thereafter=payments.get("thereafter"),
+            rate_changes=rate_changes,
+        )
 
-        if thereafter is not None:
-            thereafter.duplicate_for(self)
+        return inputs
+
+    def refresh_summary(self):
+        ledger = Ledger(mortgage=self)
+        self.total_cost = ledger.calculate_cost()
+        self.total_interest = engine.from_pence(sum(ledger.schedule.interest))
+
+        self.payoff_date = None
+        if ledger.schedule:
+            self.payoff_date = datetime.date(
+                day=1,
+                **add_months(
+                    self.start_date.year,
+                    self.start_date.month,
+                    len(ledger.schedule) - 1,
+                ),
+            )
 
-        for overpayment in overpayments:
-            overpayment.duplicate_for(self)
+        # Not `save()`, which would invalidate the ledger we've just
+        # calculated.
+        Mortgage.objects.filter(pk=self.pk).update(
+            payoff_date=self.payoff_date,
+            total_cost=self.total_cost,
+            total_interest=self.total_interest,
+        )
 
-        for discrepancy in discrepancies:
-            discrepancy.duplicate_for(self)
+    def duplicate(self, **changes):
+        """
+        A copy of this mortgage and everything about it, with `changes`
+        to its fields.
+        """
+        [duplicate] = self.duplicate_variants([changes])
+
+        return duplicate
+
+    def duplicate_variants(self, variants):
+        """
+        A copy of this mortgage and everything about it for each of
+        `variants`, a dict of changes to its fields.
+
+        Each copy is one `INSERT`, and everything about all of them is
+        one more per model, however many overrides there are.
+        """
+        fields = {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields
+            # Not the summary, which is refreshed when this commits.
+            if field.editable and not field.primary_key
+        }
 
-        return self
+        with transaction.atomic():
+            rows = list(ledger_input_rows(mortgage=self))
+
+            duplicates = []
+            for changes in variants:
+                duplicate = Mortgage(**{**fields, **changes})
+                duplicate.save()
+                duplicates.append(duplicate)
+
+            # `bulk_create` sends no signals, but nothing has been
+            # calculated for the copies yet to be invalidated.
+            copies = defaultdict(list)
+            for duplicate in duplicates:
+                for (
+                    mortgage_pk,
+                    kind,
+                    month,
+                    pk,
+                    amount,
+                    interest_rate,
+                    default_overpayment,
+                ) in rows:
+                    if kind == "rate_change":
+                        copies[RateChange].append(RateChange(
+                            mortgage=duplicate,
+                            start_month=month,
+                            interest_rate=interest_rate,
+                            payment=amount,
+                            default_overpayment=default_overpayment,
+                        ))
+                    elif kind in {"overpayment", "discrepancy"}:
+                        model = Overpayment
+                        if kind == "discrepancy":
+                            model = Discrepancy
+
+                        copies[model].append(model(
+                            mortgage=duplicate,
+                            month=month,
+                            date=add_months_to_date(
+                                duplicate.start_date,
+                                month,
+                            ),
+                            amount=amount,
+                        ))
+                    else:
+                        model = ActualInitialPayment
+                        if kind == "thereafter":
+                            model = ActualThereafterPayment
+
+                        copies[model].append(model(
+                            mortgage=duplicate,
+                            amount=amount,
+                        ))
+
+            for model, objs in copies.items():
+                model.objects.bulk_create(objs)
+
+        return duplicates
 
 
 class ActualPaymentQuerySet(models.QuerySet):
@@ -212,12 +568,6 @@ class ActualPayment(models.Model):
 
         return f"{class_name} of {self.amount}"
 
-    def duplicate_for(self, mortgage):
-        self.pk = None
-        self.mortgage = mortgage
-
-        self.save()
-
     @staticmethod
     def get_default(mortgage):
         raise NotImplementedError()
@@ -237,6 +587,82 @@ class ActualThereafterPayment(ActualPayment):
         return mortgage.default_payment_thereafter
 
 
+class RateChangeQuerySet(models.QuerySet):
+
+    def for_mortgage(self, mortgage):
+        return self.filter(mortgage=mortgage)
+
+
+class RateChangeManager(models.Manager.from_queryset(RateChangeQuerySet)):
+    pass
+
+
+class RateChange(models.Model):
+    mortgage = models.ForeignKey(
+        "mortgages.Mortgage",
+        on_delete=models.CASCADE,
+        related_name="ratechanges",
+    )
+    start_month = models.PositiveSmallIntegerField()
+    interest_rate = models.DecimalField(
+        max_digits=5,
+        decimal_places=5,
+        help_text="(1% = 0.01)",
+    )
+    payment = models.DecimalField(
+        max_digits=9,
+        decimal_places=2,
+        validators=[MinValueValidator(0)],
+        blank=True,
+        help_text="calculated automatically if left blank",
+    )
+    default_overpayment = models.DecimalField(
+        max_digits=9,
+        decimal_places=2,
+        validators=[MinValueValidator(0)],
+        blank=True,
+        help_text="calculated automatically if left blank",
+    )
+
+    objects = RateChangeManager()
+
+    class Meta:
+        ordering = ("start_month",)
+        unique_together = (
+            ("mortgage", "start_month"),
+        )
+
+    def __str__(self):
+        return f"Rate of {self.interest_rate} from month {self.start_month}"
+
+    def save(self, *args, **kwargs):
+        self.ensure_defaults()
+
+        return super().save(*args, **kwargs)
+
+    def ensure_defaults(self):
+        if self.payment is None:
+            self.payment = payment(
+                self.interest_rate / 12,
+                self.mortgage.term,
+                self.mortgage.amount,
+            )
+
+        if self.default_overpayment is None:
+            self.default_overpayment = max(
+                self.mortgage.disposable_income - self.payment,
+                0,
+            )
+
+    def as_period(self):
+        return Period(
+            interest_rate=self.interest_rate,
+            payment=self.payment,
+            default_overpayment=self.default_overpayment,
+            start_month=self.start_month,
+        )
+
+
 class AmountQuerySet(models.QuerySet):
 
     def for_mortgage(self, mortgage):
@@ -254,27 +680,59 @@ class AmountQuerySet(models.QuerySet):
     def average(self):
         return self.aggregate(a=models.Avg("amount"))["a"]
 
-    def with_current_month(self):
-        return (
-            self
-            .annotate(start_date=F("mortgage__start_date"))
-            .annotate(current_month=RawSQL(
-                "SELECT start_date + make_interval(0, month)"
-                " AS current_month",
-                (),
-            ))
-        )
-
     def in_the_past(self):
-        return (
-            self
-            .with_current_month()
-            .filter(current_month__lte=timezone.now())
-        )
+        return self.filter(date__lte=timezone.now().date())
 
 
 class AmountManager(models.Manager.from_queryset(AmountQuerySet)):
-    pass
+
+    def bulk_set(self, mortgage, amounts):
+        """
+        Set `mortgage`'s amount for each `{month: amount}`, or delete it
+        where the amount is `None`.
+
+        Updating and creating don't send signals, so the ledger is
+        invalidated from the first of the months here, once.
+        """
+        from . import signals
+
+        if not amounts:
+            return
+
+        with transaction.atomic():
+            deleted = [
+                month
+                for month, amount in amounts.items()
+                if amount is None
+            ]
+            if deleted:
+                self.filter(mortgage=mortgage, month__in=deleted).delete()
+
+            changed = {
+                month: amount
+                for month, amount in amounts.items()
+                if amount is not None
+            }
+            existing = list(
+                self
+                .filter(mortgage=mortgage, month__in=changed)
+                .select_for_update()
+            )
+            for row in existing:
+                row.amount = changed.pop(row.month)
+
+            self.bulk_update(existing, ["amount"])
+            self.bulk_create([
+                self.model(
+                    mortgage=mortgage,
+                    month=month,
+                    date=add_months_to_date(mortgage.start_date, month),
+                    amount=amount,
+                )
+                for month, amount in changed.items()
+            ])
+
+            signals.invalidate(mortgage.pk, month=min(amounts))
 
 
 class Amount(models.Model):
@@ -285,6 +743,9 @@ class Amount(models.Model):
     )
     amount = models.DecimalField(max_digits=9, decimal_places=2)
     month = models.PositiveSmallIntegerField()
+    # The date `month` falls on, kept in step with the mortgage's
+    # `start_date`, so it can be filtered on (and indexed) directly.
+    date = models.DateField(editable=False)
 
     objects = AmountManager()
 
@@ -293,17 +754,24 @@ class Amount(models.Model):
         unique_together = (
             ("mortgage", "month"),
         )
+        indexes = [
+            # With `amount` so averages over a date range needn't touch
+            # the table.
+            models.Index(
+                fields=["mortgage", "date", "amount"],
+                name="%(app_label)s_%(class)s_date",
+            ),
+        ]
 
     def __str__(self):
         class_name = self.__class__._meta.verbose_name.capitalize()
 
         return f"{class_name} of {self.amount}"
 
-    def duplicate_for(self, mortgage):
-        self.pk = None
-        self.mortgage = mortgage
+    def save(self, *args, **kwargs):
+        self.date = add_months_to_date(self.mortgage.start_date, self.month)
 
-        self.save()
+        return super().save(*args, **kwargs)
 
 
 class Overpayment(Amount):
@@ -314,6 +782,257 @@ class Discrepancy(Amount):
     pass
 
 
+class LedgerMonthQuerySet(models.QuerySet):
+
+    def for_mortgage(self, mortgage):
+        return self.filter(mortgage=mortgage)
+
+    def as_schedule(self):
+        schedule = engine.Schedule()
+        for row in self.order_by("month_number").values_list(*engine.COLUMNS):
+            schedule.append(*row)
+
+        return schedule
+
+    def cost(self):
+        """
+        In pence.
+        """
+        return self.aggregate(
+            cost=models.Sum(F("interest") + F("discrepancy")),
+        )["cost"] or 0
+
+
+def transaction_state(connection, name):
+    """
+    A dict kept on `connection` for the rest of its current transaction,
+    and forgotten once that's committed or rolled back.  Outside of one,
+    a new dict every time.
+    """
+    if not connection.in_atomic_block:
+        return {}
+
+    state, marker = getattr(connection, name, (None, None))
+
+    # Django lets go of everything it was going to run on commit once it's
+    # committed or rolled back, this included.
+    if marker is None or marker() is None:
+        state = {}
+
+        def forget():
+            pass
+
+        transaction.on_commit(forget, using=connection.alias)
+        setattr(connection, name, (state, weakref.ref(forget)))
+
+    return state
+
+
+class LedgerMonthManager(models.Manager.from_queryset(LedgerMonthQuerySet)):
+
+    def _invalidated(self):
+        """
+        `{mortgage_pk: month}` of the months thrown away in the current
+        transaction, and not stored again since.
+        """
+        return transaction_state(
+            connections[self.db],
+            "invalidated_ledger_months",
+        )
+
+    def materialise(self, mortgage, schedule, start):
+        """
+        Store the months of `schedule` from `start` onwards.
+        """
+        self._invalidated().pop(mortgage.pk, None)
+
+        self.bulk_create(
+            [
+                LedgerMonth(
+                    mortgage=mortgage,
+                    month_number=month_number,
+                    **{
+                        column: getattr(schedule, column)[month_number]
+                        for column in engine.COLUMNS
+                    },
+                )
+                for month_number in range(start, len(schedule))
+            ],
+            # Someone else got there first, with the same numbers.
+            ignore_conflicts=True,
+        )
+
+    def invalidate(self, mortgage_pk, month=0):
+        """
+        Throw away the months from `month` on, unless they already have
+        been in this transaction.
+        """
+        invalidated = self._invalidated()
+        if mortgage_pk in invalidated:
+            if invalidated[mortgage_pk] <= month:
+                return
+
+            # Changing several months, in no particular order; throwing
+            # them all away covers whatever comes next.
+            month = 0
+
+        invalidated[mortgage_pk] = month
+
+        self.filter(
+            mortgage_id=mortgage_pk,
+            month_number__gte=month,
+        ).delete()
+
+    def deleting(self, mortgage_pk):
+        """
+        Skip invalidating the months of a mortgage that's being deleted,
+        which go with it.
+        """
+        self._invalidated()[mortgage_pk] = 0
+
+
+class LedgerMonth(models.Model):
+    """
+    A calculated month of a mortgage's saved ledger, in pence.
+
+    Rows are thrown away from the first month an override changes, and
+    filled back in by `Ledger` the next time it's calculated.
+    """
+    mortgage = models.ForeignKey(
+        "mortgages.Mortgage",
+        on_delete=models.CASCADE,
+        related_name="ledgermonths",
+    )
+    month_number = models.PositiveSmallIntegerField()
+    opening_balance = models.BigIntegerField()
+    interest = models.BigIntegerField()
+    payment = models.BigIntegerField()
+    overpayment = models.BigIntegerField()
+    discrepancy = models.BigIntegerField()
+    default_overpayment = models.BigIntegerField()
+
+    objects = LedgerMonthManager()
+
+    class Meta:
+        unique_together = (
+            ("mortgage", "month_number"),
+        )
+
+
+class JobQuerySet(models.QuerySet):
+
+    def owned_by(self, user):
+        return self.filter(mortgage__owner=user)
+
+
+class JobManager(models.Manager.from_queryset(JobQuerySet)):
+
+    def claim(self):
+        """
+        Mark the oldest pending job as running and return it, or `None` if
+        there aren't any.  Safe against other workers claiming at once.
+
+        Jobs left running for longer than `JOB_TIMEOUT`, whose workers are
+        presumably gone, count as pending again.
+        """
+        while True:
+            stale = timezone.now() - datetime.timedelta(
+                seconds=settings.JOB_TIMEOUT,
+            )
+            job = (
+                self
+                .filter(
+                    Q(status=Job.PENDING)
+                    | Q(status=Job.RUNNING, started__lt=stale)
+                )
+                .order_by("created", "pk")
+                .first()
+            )
+            if job is None:
+                return None
+
+            started = timezone.now()
+            claimed = self.filter(
+                pk=job.pk,
+                status=job.status,
+                started=job.started,
+            ).update(
+                status=Job.RUNNING,
+                started=started,
+            )
+            if claimed:
+                job.status = Job.RUNNING
+                job.started = started
+
+                return job
+
+
+class Job(models.Model):
+    """
+    A ledger calculation to run away from the request that asked for it,
+    by `manage.py runjobs`.  See `jobs`.
+    """
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUSES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    mortgage = models.ForeignKey(
+        "mortgages.Mortgage",
+        on_delete=models.CASCADE,
+        related_name="jobs",
+    )
+    kind = models.CharField(max_length=32)
+    # As submitted to the kind's form.
+    parameters = models.JSONField()
+    # Of the kind, its parameters and everything about the mortgage they
+    # depend on, so a job can be reused until any of those change.
+    key = models.CharField(max_length=64)
+    status = models.CharField(
+        max_length=16,
+        choices=STATUSES,
+        default=PENDING,
+    )
+    # From 0 to 1.
+    progress = models.FloatField(default=0)
+    result = models.JSONField(null=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+    objects = JobManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["mortgage", "key"]),
+            models.Index(fields=["status", "created"]),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} job for mortgage {self.mortgage_id}"
+
+    def get_absolute_url(self):
+        return reverse("mortgages:job", kwargs={"pk": self.pk})
+
+    def as_dict(self):
+        return {
+            "id": self.pk,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "url": self.get_absolute_url(),
+        }
+
+
 @attr.s
 class LedgerEntryAmount:
     ledger_entry = attr.ib()
@@ -338,7 +1057,7 @@ class LedgerEntryAmount:
         return f"{self.type}_amount_{self.month_number}"
 
 
-@attr.s
+@attr.s(slots=True)
 class LedgerEntry:
     month_number = attr.ib()
     mortgage_pk = attr.ib()
@@ -353,7 +1072,7 @@ class LedgerEntry:
     overpayment_pk = attr.ib(default=None)
     discrepancy_pk = attr.ib(default=None)
 
-    default_overpayment = None
+    default_overpayment = attr.ib(init=False, default=None, eq=False)
 
     def __attrs_post_init__(self):
         self.default_overpayment = self.overpayment
@@ -368,13 +1087,13 @@ class LedgerEntry:
 
     @property
     def closing_balance(self):
-        return sum([
-            self.opening_balance,
-            self.interest,
-            self.payment,
-            self.overpayment,
-            self.discrepancy,
-        ])
+        return (
+            self.opening_balance
+            + self.interest
+            + self.payment
+            + self.overpayment
+            + self.discrepancy
+        )
 
     def normalise(self):
         if self.closing_balance > 0:
@@ -391,7 +1110,7 @@ class LedgerEntry:
 
     @property
     def month_name(self):
-        return f"{self.year}-{self.month:02d}"
+        return month_name(year=self.year, month=self.month)
 
     @property
     def as_tds(self):
@@ -423,6 +1142,37 @@ class LedgerEntry:
         }
 
 
+class LedgerEntries(Sequence):
+    """
+    A `Ledger`'s months as `LedgerEntry`s, made as and when they're asked
+    for rather than kept around.
+    """
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+
+    def __len__(self):
+        return len(self.ledger.schedule)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [
+                self.ledger.entry(month_number)
+                for month_number in range(*index.indices(len(self)))
+            ]
+
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        return self.ledger.entry(index)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+
 @attr.s
 class Period:
     interest_rate = attr.ib()
@@ -435,97 +1185,104 @@ class Period:
 class Periods:
     periods = attr.ib()
 
-    @property
-    def sorted_periods(self):
-        return sorted(
+    start_months = None
+
+    def __attrs_post_init__(self):
+        self.periods = sorted(
             self.periods,
             key=lambda period: period.start_month,
-            reverse=True,
         )
+        self.start_months = [period.start_month for period in self.periods]
 
     def get_period(self, month):
-        for period in self.sorted_periods:
-            if period.start_month <= month:
-                return period
+        index = bisect_right(self.start_months, month)
+        if index:
+            return self.periods[index - 1]
+
+
+@attr.s(slots=True, frozen=True)
+class AmountRow:
+    """
+    The parts of an `Overpayment` or `Discrepancy` that `Ledger` uses.
+    """
+    pk = attr.ib()
+    amount = attr.ib()
+
+
+@attr.s
+class LedgerInputs:
+    periods = attr.ib(default=None)
+    overpayments = attr.ib(factory=dict)
+    discrepancies = attr.ib(factory=dict)
 
 
 @attr.s
 class Ledger:
     mortgage = attr.ib()
+    # Whether to store what's calculated for next time.
+    store = attr.ib(default=True)
 
-    ledger = None
+    schedule = None
 
     _overpayments = None
     _discrepancies = None
     _periods = None
 
+    # Whether any overrides differ from what's saved.
+    edited = False
+
     def __attrs_post_init__(self):
-        self.ledger = []
+        self.schedule = engine.Schedule()
 
     @property
-    def periods(self):
-        if self._periods is not None:
-            return self._periods
+    def ledger(self):
+        return LedgerEntries(ledger=self)
+
+    def _load_inputs(self):
+        self.set_inputs(self.mortgage.load_ledger_inputs())
 
-        self._periods = self.mortgage.as_periods()
+    def set_inputs(self, inputs):
+        self._periods = inputs.periods
+        self._overpayments = inputs.overpayments
+        self._discrepancies = inputs.discrepancies
+
+    @property
+    def periods(self):
+        if self._periods is None:
+            self._load_inputs()
 
         return self._periods
 
     @property
     def balance(self):
-        if not self.ledger:
-            return -self.mortgage.amount
+        """
+        In pence.
+        """
+        if not self.schedule:
+            return -engine.to_pence(self.mortgage.amount)
 
-        return self.ledger[-1].closing_balance
+        return self.schedule.balance
 
     @property
     def complete(self):
         return self.balance == 0
 
-    @property
-    def next_year_month(self):
-        if not self.ledger:
-            return {
-                "year": self.mortgage.start_date.year,
-                "month": self.mortgage.start_date.month,
-            }
-
-        month = self.ledger[-1].month + 1
-        year = self.ledger[-1].year
-        if month == 13:  # Decemberer.
-            month = 1
-            year += 1
-
-        return {"year": year, "month": month}
-
     @property
     def overpayments(self):
-        if self._overpayments is not None:
-            return self._overpayments
-
-        self._overpayments = (
-            Overpayment.objects
-            .for_mortgage(self.mortgage)
-            .as_monthly_dict()
-        )
+        if self._overpayments is None:
+            self._load_inputs()
 
         return self._overpayments
 
     @property
     def discrepancies(self):
-        if self._discrepancies is not None:
-            return self._discrepancies
-
-        self._discrepancies = (
-            Discrepancy.objects
-            .for_mortgage(self.mortgage)
-            .as_monthly_dict()
-        )
+        if self._discrepancies is None:
+            self._load_inputs()
 
         return self._discrepancies
 
     def _set_amount(self, overpayments, month, to):
-        target = self._overpayments if overpayments else self._discrepancies
+        target = self.overpayments if overpayments else self.discrepancies
 
         current = target.get(month)
         if current == to:
@@ -536,7 +1293,8 @@ class Ledger:
         else:
             target[month] = to
 
-        self.ledger = self.ledger[:month]
+        self.edited = True
+        self.schedule.truncate(month)
 
     def set_overpayment(self, month, to):
         return self._set_amount(overpayments=True, month=month, to=to)
@@ -550,54 +1308,430 @@ class Ledger:
     def delete_discrepancy(self, month):
         return self._set_amount(overpayments=False, month=month, to=None)
 
-    def calculate_entry(self):
-        month_number = len(self.ledger)
-        period = self.periods.get_period(month_number)
+    @property
+    def pence_periods(self):
+        return [
+            engine.PencePeriod.from_period(period)
+            for period in self.periods.periods
+        ]
+
+    @property
+    def pence_overpayments(self):
+        return {
+            month: engine.to_pence(overpayment.amount)
+            for month, overpayment in self.overpayments.items()
+        }
+
+    @property
+    def pence_discrepancies(self):
+        return {
+            month: engine.to_pence(discrepancy.amount)
+            for month, discrepancy in self.discrepancies.items()
+        }
+
+    def _calculate(self, end=None):
+        if self.complete:
+            return
+
+        from_scratch = not self.schedule and end is None
+        if from_scratch:
+            self._load()
+
+            return
+
+        self._simulate(end=end)
+
+    def _simulate(self, end=None):
+        with metrics.timing("ledger"):
+            engine.simulate(
+                balance=self.balance,
+                periods=self.pence_periods,
+                overpayments=self.pence_overpayments,
+                discrepancies=self.pence_discrepancies,
+                start=len(self.schedule),
+                end=end,
+                schedule=self.schedule,
+            )
+
+    def _load(self):
+        """
+        Fill `schedule` from the cheapest place that has it, falling back
+        to calculating whatever's missing.
+        """
+        if self.edited or self.mortgage.pk is None:
+            schedule = caching.get_by_content(self)
+            if schedule is not None:
+                self.schedule = schedule
+
+                return
+
+            self._simulate()
+            caching.set_schedule(self, self.schedule)
+
+            return
+
+        schedule = caching.get_by_mortgage(self)
+        if schedule is not None:
+            self.schedule = schedule
+
+            return
+
+        # The inputs before the months stored from them, which are thrown
+        # away whenever they change, so the two can only disagree by there
+        # being fewer months than the inputs would make.
+        if self._periods is None:
+            self._load_inputs()
+        self.schedule = (
+            LedgerMonth.objects.for_mortgage(self.mortgage).as_schedule()
+        )
+        materialised = len(self.schedule)
+
+        if not self.complete:
+            schedule = caching.get_by_content(self)
+            if schedule is not None:
+                self.schedule = schedule
+            else:
+                self._simulate()
+
+        caching.set_schedule(self, self.schedule)
+        if self.store:
+            self._store(materialised)
+
+    def _store(self, materialised):
+        """
+        Store the months of `schedule` from `materialised` onwards and
+        point the mortgage at it, unless anything going into it has
+        changed since the mortgage was read, when it belongs to nobody.
+
+        Invalidating moves `ledger_version` on under the same lock, held
+        until the change is committed, so a change either lands before
+        this checks or clears up after it.
+        """
+        if materialised == len(self.schedule):
+            # Nothing new; not worth the lock just to point at it.
+            return
+
+        with transaction.atomic():
+            version = (
+                Mortgage.objects
+                .select_for_update()
+                .filter(pk=self.mortgage.pk)
+                .values_list("ledger_version", flat=True)
+                .first()
+            )
+            if version != self.mortgage.ledger_version:
+                return
+
+            LedgerMonth.objects.materialise(
+                mortgage=self.mortgage,
+                schedule=self.schedule,
+                start=materialised,
+            )
+            caching.set_pointer(self)
+
+    def entry(self, month_number):
+        """
+        Turn `month_number` of `schedule` back into `Decimal`s, for
+        templates and views.
+        """
+        schedule = self.schedule
+        start_date = self.mortgage.start_date
 
         entry = LedgerEntry(
             month_number=month_number,
             mortgage_pk=self.mortgage.pk,
-            **self.next_year_month,
-            opening_balance=self.balance,
-            interest=round(self.balance * period.interest_rate / 12, 2),
-            payment=period.payment,
-            overpayment=period.default_overpayment,
-            discrepancy=Decimal("0"),
+            **add_months(start_date.year, start_date.month, month_number),
+            opening_balance=engine.from_pence(
+                schedule.opening_balance[month_number],
+            ),
+            interest=engine.from_pence(schedule.interest[month_number]),
+            payment=engine.from_pence(schedule.payment[month_number]),
+            overpayment=engine.from_pence(
+                schedule.default_overpayment[month_number],
+            ),
+            discrepancy=engine.from_pence(schedule.discrepancy[month_number]),
+        )
+        entry.overpayment = engine.from_pence(
+            schedule.overpayment[month_number],
         )
 
-        # If there are real values for this month's discrepancy or
-        # overpayment, use those instead.
         overpayment = self.overpayments.get(month_number)
         if overpayment is not None:
-            entry.overpayment = overpayment.amount
             entry.overpayment_pk = overpayment.pk
 
         discrepancy = self.discrepancies.get(month_number)
         if discrepancy is not None:
-            entry.discrepancy = discrepancy.amount
             entry.discrepancy_pk = discrepancy.pk
 
-        entry.normalise()
+        return entry
 
-        self.ledger.append(entry)
+    def calculate_entry(self):
+        self._calculate(end=len(self.schedule) + 1)
 
     def calculate_entries(self):
-        while not self.complete:
-            self.calculate_entry()
+        self._calculate()
 
     def calculate_cost(self):
         self.calculate_entries()
 
-        return sum(sum(
-            [[entry.interest, entry.discrepancy] for entry in self.ledger],
-            [],
-        ))
+        return engine.from_pence(self.schedule.cost)
+
+    def _iter_costs_without(self, iter_costs_without):
+        self.calculate_entries()
+
+        costs = iter_costs_without(
+            schedule=self.schedule,
+            periods=self.pence_periods,
+            overpayments=self.pence_overpayments,
+            discrepancies=self.pence_discrepancies,
+        )
+        while True:
+            # Only timing working the costs out, not whatever they're
+            # wanted for in between.
+            with metrics.timing("ledger"):
+                month_cost = next(costs, None)
+
+            if month_cost is None:
+                return
+
+            metrics.count("counterfactuals")
+            month, cost = month_cost
+            yield month, engine.from_pence(cost)
+
+    def iter_costs_without_overpayments(self):
+        """
+        `costs_without_overpayments` as `(month, cost)` pairs in month
+        order, each calculated as it's asked for.
+        """
+        return self._iter_costs_without(
+            engine.iter_costs_without_overpayments,
+        )
+
+    def costs_without_overpayments(self):
+        """
+        How much more each overpayment's absence would make the mortgage
+        cost (negative for less), keyed by month.
+        """
+        return dict(self.iter_costs_without_overpayments())
+
+    def iter_costs_without_discrepancies(self):
+        """
+        `costs_without_discrepancies` as `(month, cost)` pairs in month
+        order, each calculated as it's asked for.
+        """
+        return self._iter_costs_without(
+            engine.iter_costs_without_discrepancies,
+        )
+
+    def costs_without_discrepancies(self):
+        return dict(self.iter_costs_without_discrepancies())
+
+    def speculation_grid(self, amounts, months):
+        """
+        What spending each of `amounts` in each of `months` would cost over
+        the whole mortgage, found by cutting overpayments from that month
+        backwards.
+
+        Returns `{(amount, month): (cost, no_money)}`, where `no_money` is
+        whether there weren't enough overpayments to cut.
+        """
+        self.calculate_entries()
+
+        pence_amounts = {engine.to_pence(amount): amount for amount in amounts}
+        with metrics.timing("ledger"):
+            grid = engine.speculation_grid(
+                schedule=self.schedule,
+                periods=self.pence_periods,
+                overpayments=self.pence_overpayments,
+                discrepancies=self.pence_discrepancies,
+                amounts=pence_amounts,
+                months=months,
+            )
+        metrics.count("counterfactuals", len(grid))
+
+        return {
+            (pence_amounts[amount], month): (engine.from_pence(cost), no_money)
+            for (amount, month), (cost, no_money) in grid.items()
+        }
+
+    def optimise_overpayments(self, budget):
+        """
+        The overpayments, keyed by month, which spend no more than `budget`
+        in total on top of those already planned, and no more than the
+        disposable income left after each month's payment altogether, and
+        make the mortgage as cheap as possible.
+
+        Returns the months that change along with the resulting total
+        cost, which is what setting them gives.
+        """
+        self.calculate_entries()
+
+        disposable_income = engine.to_pence(self.mortgage.disposable_income)
+        periods = self.pence_periods
+
+        with metrics.timing("ledger"):
+            overpayments, schedule = engine.optimise_overpayments(
+                schedule=self.schedule,
+                balance=-engine.to_pence(self.mortgage.amount),
+                periods=periods,
+                overpayments=self.pence_overpayments,
+                discrepancies=self.pence_discrepancies,
+                budget=engine.to_pence(budget),
+                caps={
+                    period.start_month: disposable_income - period.payment
+                    for period in periods
+                },
+            )
+
+        return (
+            {
+                month: engine.from_pence(overpayment)
+                for month, overpayment in overpayments.items()
+            },
+            engine.from_pence(schedule.cost),
+        )
+
+    def simulate_rates(self, paths, drift, volatility, seed, workers=None):
+        """
+        Run `paths` random walks of the interest rate from the end of the
+        initial period onwards (see `montecarlo.run`), and summarise the
+        total costs and payoff dates they lead to as percentiles.
+
+        `workers` is capped at, and defaults to, `MONTE_CARLO_WORKERS`.
+        """
+        if workers is None:
+            workers = settings.MONTE_CARLO_WORKERS
+        workers = min(workers, settings.MONTE_CARLO_WORKERS)
+
+        self.calculate_entries()
+
+        schedule = self.schedule
+        periods = self.periods
+        pence_periods = {
+            period.start_month: period
+            for period in self.pence_periods
+        }
+        overpayments = self.pence_overpayments
+        discrepancies = self.pence_discrepancies
+
+        start = min(self.mortgage.initial_period, len(schedule))
+        horizon = 2 * max(self.mortgage.term, len(schedule))
+
+        payments = []
+        default_overpayments = []
+        for month_number in range(start, horizon):
+            start_month = periods.get_period(month_number).start_month
+            period = pence_periods[start_month]
+            payments.append(period.payment)
+            default_overpayments.append(period.default_overpayment)
+
+        months = montecarlo.Months(
+            start=start,
+            balance=(
+                schedule.opening_balance[start]
+                if start < len(schedule)
+                else 0
+            ),
+            cost=(
+                sum(schedule.interest[:start])
+                + sum(schedule.discrepancy[:start])
+            ),
+            payment=payments,
+            overpayment=[
+                overpayments.get(month_number, default_overpayment)
+                for month_number, default_overpayment in enumerate(
+                    default_overpayments,
+                    start=start,
+                )
+            ],
+            discrepancy=[
+                discrepancies.get(month_number, 0)
+                for month_number in range(start, horizon)
+            ],
+        )
+
+        with metrics.timing("ledger"):
+            outcome = montecarlo.run(
+                months=months,
+                rate=round(
+                    periods.get_period(start).interest_rate
+                    * montecarlo.RATE_PLACES
+                ),
+                drift=drift,
+                volatility=volatility,
+                paths=paths,
+                seed=seed,
+                workers=workers,
+            )
+
+        start_date = self.mortgage.start_date
+
+        return {
+            "paths": paths,
+            "unpaid": outcome.unpaid,
+            "costs": {
+                point: engine.from_pence(cost)
+                for point, cost in montecarlo.percentiles(
+                    outcome.costs,
+                ).items()
+            },
+            # The last month of each percentile's ledger.
+            "payoffs": {
+                point: month_name(**add_months(
+                    start_date.year,
+                    start_date.month,
+                    term - 1,
+                ))
+                for point, term in montecarlo.percentiles(
+                    outcome.terms,
+                ).items()
+            },
+        }
+
+    def speculate(self, amount, month):
+        return self.speculation_grid(amounts=[amount], months=[month])[
+            amount,
+            month,
+        ]
 
     @property
     def month_choices(self):
         self.calculate_entries()
 
+        start_date = self.mortgage.start_date
+
         return tuple((
-            (entry.month_number, entry.month_name)
-            for entry in self.ledger
+            (month_number, month_name(**add_months(
+                start_date.year,
+                start_date.month,
+                month_number,
+            )))
+            for month_number in range(len(self.schedule))
         ))
+
+    def average_past_overpayment(self):
+        """
+        What `Overpayment.objects.in_the_past().average()` gives, from
+        the overpayments already loaded.
+        """
+        today = timezone.now().date()
+        start_date = self.mortgage.start_date
+
+        months = (
+            (today.year - start_date.year) * 12
+            + today.month - start_date.month
+        )
+        # Adding months clamps to the end of shorter ones.
+        day = min(start_date.day, monthrange(today.year, today.month)[1])
+        if day > today.day:
+            months -= 1
+
+        amounts = [
+            overpayment.amount
+            for month, overpayment in self.overpayments.items()
+            if month <= months
+        ]
+        if not amounts:
+            return None
+
+        return sum(amounts) / len(amounts)
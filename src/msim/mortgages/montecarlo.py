@@ -0,0 +1,168 @@
+"""
+Random interest rate paths for the thereafter period.
+
+Like `engine`, this works in pence and knows nothing about the ORM.  Rates
+are whole hundred-thousandths (the precision `Mortgage` stores them in),
+so interest is rounded exactly as it is in the ledger.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import functools
+from math import ceil, sqrt
+import random
+
+import attr
+
+from .engine import round_div
+
+
+RATE_PLACES = 100000
+
+# Paths are generated in chunks of this many, each with its own generator,
+# so the results for a given seed don't depend on how many processes ran
+# them.
+CHUNK_SIZE = 500
+
+# Up to this many paths are run in the calling process, where shipping them
+# off to others would cost more than it saves.
+IN_PROCESS_PATHS = 2 * CHUNK_SIZE
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+@attr.s
+class Months:
+    """
+    Everything about each month from `start` to `horizon` that doesn't
+    depend on the rate, as one list per column.
+    """
+    start = attr.ib()
+    balance = attr.ib()
+    cost = attr.ib()
+    payment = attr.ib()
+    overpayment = attr.ib()
+    discrepancy = attr.ib()
+
+
+@attr.s
+class Outcome:
+    costs = attr.ib()
+    # Number of months to pay off.
+    terms = attr.ib()
+    # Paths not paid off by the horizon.
+    unpaid = attr.ib()
+
+
+def _run_paths(months, rate, drift, volatility, paths, seed):
+    generator = random.Random(seed)
+    gauss = generator.gauss
+
+    # Monthly steps of an annual random walk, in hundred-thousandths.
+    mu = drift * RATE_PLACES / 12
+    sigma = volatility * RATE_PLACES / sqrt(12)
+    denominator = RATE_PLACES * 12
+
+    horizon = len(months.payment)
+    payments = months.payment
+    overpayments = months.overpayment
+    discrepancies = months.discrepancy
+
+    costs = []
+    terms = []
+    unpaid = 0
+    for _ in range(paths):
+        path_rate = rate
+        balance = months.balance
+        cost = months.cost
+        index = 0
+        while balance != 0 and index < horizon:
+            interest = round_div(balance * path_rate, denominator)
+            payment = payments[index]
+            discrepancy = discrepancies[index]
+
+            closing_balance = (
+                balance + interest + payment + overpayments[index]
+                + discrepancy
+            )
+
+            # Mirrors `engine._step`.
+            if closing_balance > 0:
+                owed = balance + interest + discrepancy
+                payment = min(payment, abs(owed))
+                closing_balance = owed + payment + abs(owed + payment)
+
+            cost += interest + discrepancy
+            balance = closing_balance
+            index += 1
+
+            path_rate = max(path_rate + round(gauss(mu, sigma)), 0)
+
+        if balance != 0:
+            unpaid += 1
+
+            continue
+
+        costs.append(cost)
+        terms.append(months.start + index)
+
+    return Outcome(costs=costs, terms=terms, unpaid=unpaid)
+
+
+def _run_chunk(kwargs):
+    return _run_paths(**kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def get_executor(workers):
+    """
+    A pool of `workers` processes, started the first time it's asked for
+    and kept for every run after.
+    """
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def run(months, rate, drift, volatility, paths, seed, workers=1):
+    """
+    Run `paths` random rate paths over `months`, starting at `rate`
+    (hundred-thousandths), moving by `drift` a year on average with
+    annual standard deviation `volatility` (both as fractions, like
+    `Mortgage.interest_rate_thereafter`), and never going below zero.
+
+    Chunks of paths are farmed out to `get_executor(workers)`, or run here
+    if there are only `IN_PROCESS_PATHS` or one worker.
+    """
+    chunks = [
+        {
+            "months": months,
+            "rate": rate,
+            "drift": drift,
+            "volatility": volatility,
+            "paths": min(CHUNK_SIZE, paths - offset),
+            "seed": f"{seed}:{offset}",
+        }
+        for offset in range(0, paths, CHUNK_SIZE)
+    ]
+
+    if paths <= IN_PROCESS_PATHS or workers <= 1:
+        outcomes = [_run_chunk(chunk) for chunk in chunks]
+    else:
+        outcomes = list(get_executor(workers).map(_run_chunk, chunks))
+
+    return Outcome(
+        costs=[cost for outcome in outcomes for cost in outcome.costs],
+        terms=[term for outcome in outcomes for term in outcome.terms],
+        unpaid=sum(outcome.unpaid for outcome in outcomes),
+    )
+
+
+def percentiles(values, points=PERCENTILES):
+    """
+    Nearest rank percentiles, as `{point: value}`.
+    """
+    values = sorted(values)
+    if not values:
+        return {}
+
+    return {
+        point: values[max(ceil(point / 100 * len(values)) - 1, 0)]
+        for point in points
+    }
@@ -0,0 +1,78 @@
+"""
+Running the views that calculate ledgers off the event loop.
+
+Under ASGI, Django runs every sync view in the one thread, so a detail page
+working through a long ledger holds up every other request on the worker.
+Views wrapped by `offloaded` are async instead, and run themselves in a
+bounded pool of threads of their own, leaving that thread and the event
+loop free for everything else.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+
+
+@functools.lru_cache(maxsize=None)
+def get_executor():
+    return ThreadPoolExecutor(
+        max_workers=settings.LEDGER_WORKERS,
+        thread_name_prefix="ledger",
+    )
+
+
+def _run(view, request, *args, **kwargs):
+    # Requests only tidy up the connections of the thread they finish in.
+    close_old_connections()
+    try:
+        response = view(request, *args, **kwargs)
+
+        # Templates can query and calculate as well, and would otherwise
+        # be rendered back in the shared thread.
+        if hasattr(response, "render") and callable(response.render):
+            response.render()
+
+        return response
+    finally:
+        close_old_connections()
+
+
+def offloaded(view):
+    """
+    `view`, as an async view running it in `get_executor()`'s threads.
+
+    Outside of ASGI, where every request has a thread of its own anyway,
+    it's run where it would have been.
+    """
+    @functools.wraps(view)
+    async def offloaded_view(request, *args, **kwargs):
+        if not isinstance(request, ASGIRequest):
+            return await sync_to_async(view, thread_sensitive=True)(
+                request,
+                *args,
+                **kwargs,
+            )
+
+        # Unlike `sync_to_async`, executors don't carry the context over,
+        # and `metrics` records through it.
+        context = contextvars.copy_context()
+
+        return await asyncio.get_event_loop().run_in_executor(
+            get_executor(),
+            functools.partial(
+                context.run,
+                _run,
+                view,
+                request,
+                *args,
+                **kwargs,
+            ),
+        )
+
+    return offloaded_view
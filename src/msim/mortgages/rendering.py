@@ -0,0 +1,338 @@
+"""
+The detail page's ledger table, rendered straight from a `Schedule`.
+
+Going through `LedgerEntry.as_tds` and `_extra_cost.html` means three
+template renders and a pile of `intcomma`s for every month, which is most
+of the page for a long mortgage.  This produces exactly the same bytes
+from plain string fragments, formatting pence directly.
+"""
+from django.conf import settings
+from django.contrib.humanize.templatetags.humanize import intcomma
+from django.template.defaultfilters import floatformat
+from django.urls import reverse
+from django.utils.formats import get_format, localize
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+import attr
+
+from . import engine, metrics
+from .utils import add_months, month_name
+
+
+AMOUNT = (
+    "\n\n<input\n"
+    '  name="{name}"\n'
+    '  id="{name}"\n'
+    '  value="{amount}"\n'
+    "/>\n"
+    "\n"
+    "<button\n"
+    '  data-name="{name}"\n'
+    '  data-url="{create_update_url}"\n'
+    '  onclick="amountSave(\n'
+    "    this.dataset.url,\n"
+    "    this.dataset.name,\n"
+    "    {month_number}\n"
+    '  )"\n'
+    '  type="button"\n'
+    ">\n"
+    "  SAVE\n"
+    "</button>\n"
+    "\n"
+    "{delete}\n"
+)
+
+DELETE = (
+    "\n  <button\n"
+    '    data-url="{delete_url}"\n'
+    '    onclick="amountDelete(this.dataset.url)"\n'
+    '    type="button"\n'
+    "  >\n"
+    "    DELETE\n"
+    "  </a>\n"
+)
+
+EXTRA_COST = (
+    "\n              \n\n\n"
+    "Overpaying {delta}\n"
+    "\n  \n"
+    "    {comparison}\n"
+    "  \n\n"
+    "you {extra_cost}\n"
+    "(making that delta worth {worth})\n"
+    "\n            "
+)
+
+LESS = 'less than usual <span class="costs">costs</span>'
+MORE = 'more than usual <span class="saves">saves</span>'
+
+ROW = (
+    "\n      <tr>\n        \n\n"
+    "<td>{month_name}</td>\n"
+    "<td>{opening_balance}</td>\n"
+    "<td>{interest}</td>\n"
+    "<td>{payment}</td>\n"
+    "<td>\n  {overpayment}\n</td>\n"
+    "<td>\n  {discrepancy}\n</td>\n"
+    "<td>{closing_balance}</td>\n"
+    "\n        <td>\n          \n            {extra_cost}\n          \n"
+    "        </td>\n"
+    "      </tr>\n    "
+)
+
+
+def _grouped(pence):
+    pounds, pennies = divmod(abs(pence), 100)
+
+    return f"{'-' if pence < 0 else ''}{pounds:,}.{pennies:02d}"
+
+
+def _plain(pence):
+    pounds, pennies = divmod(abs(pence), 100)
+
+    return f"{'-' if pence < 0 else ''}{pounds}.{pennies:02d}"
+
+
+@attr.s
+class MoneyFormat:
+    """
+    How the templates show pence: `grouped` as `intcomma` does, and
+    `plain` as a bare `{{ amount }}` does.
+    """
+    grouped = attr.ib()
+    plain = attr.ib()
+
+    @classmethod
+    def for_active_language(cls):
+        fast = (
+            settings.USE_L10N
+            and not settings.USE_THOUSAND_SEPARATOR
+            and get_format("DECIMAL_SEPARATOR") == "."
+            and get_format("THOUSAND_SEPARATOR") == ","
+            and get_format("NUMBER_GROUPING") == 3
+        )
+        if fast:
+            return cls(grouped=_grouped, plain=_plain)
+
+        return cls(
+            grouped=lambda pence: intcomma(engine.from_pence(pence)),
+            plain=lambda pence: localize(engine.from_pence(pence)),
+        )
+
+
+def _amount(
+    money,
+    type,
+    month_number,
+    pence,
+    pk,
+    create_update_url,
+):
+    delete = ""
+    if pk:
+        delete = DELETE.format(
+            delete_url=escape(reverse(
+                f"mortgages:{type}.delete",
+                kwargs={"pk": pk},
+            )),
+        )
+
+    return AMOUNT.format(
+        name=f"{type}_amount_{month_number}",
+        amount=money.plain(pence),
+        create_update_url=create_update_url,
+        month_number=month_number,
+        delete=delete,
+    )
+
+
+def _extra_cost(money, delta, extra_cost):
+    if extra_cost is None:
+        return ""
+
+    extra_cost = engine.to_pence(extra_cost)
+
+    return EXTRA_COST.format(
+        delta=money.plain(abs(delta)),
+        comparison=LESS if delta > 0 else MORE,
+        extra_cost=money.plain(abs(extra_cost)),
+        worth=money.plain(abs(delta + extra_cost)),
+    )
+
+
+def _rows(ledger, extra_costs, months=None):
+    """
+    `(month_number, html)` for each row of the ledger table, or just those
+    in `months`.
+
+    `extra_costs` are each overpayment's `(month, cost)` in month order, as
+    from `Ledger.iter_costs_without_overpayments`, and are only asked for
+    as their rows are reached.
+    """
+    ledger.calculate_entries()
+
+    money = MoneyFormat.for_active_language()
+    mortgage_pk = ledger.mortgage.pk
+    start_date = ledger.mortgage.start_date
+    overpayments = ledger.overpayments
+    discrepancies = ledger.discrepancies
+    urls = {
+        type: escape(reverse(
+            f"mortgages:{type}.create_update",
+            kwargs={"pk": mortgage_pk},
+        ))
+        for type in ["overpayment", "discrepancy"]
+    }
+
+    extra_costs = iter(extra_costs)
+    extra_cost_month, extra_cost = next(extra_costs, (None, None))
+
+    for month_number, (
+        opening_balance,
+        interest,
+        payment,
+        overpayment,
+        discrepancy,
+        default_overpayment,
+    ) in enumerate(zip(*ledger.schedule.columns)):
+        row_extra_cost = None
+        if extra_cost_month == month_number:
+            row_extra_cost = extra_cost
+            extra_cost_month, extra_cost = next(extra_costs, (None, None))
+
+        if months is not None and month_number not in months:
+            continue
+
+        overpayment_row = overpayments.get(month_number)
+        discrepancy_row = discrepancies.get(month_number)
+
+        with metrics.timing("render"):
+            row = ROW.format(
+                month_name=month_name(**add_months(
+                    start_date.year,
+                    start_date.month,
+                    month_number,
+                )),
+                opening_balance=money.grouped(opening_balance),
+                interest=money.grouped(interest),
+                payment=money.grouped(payment),
+                overpayment=_amount(
+                    money,
+                    "overpayment",
+                    month_number,
+                    overpayment,
+                    overpayment_row and overpayment_row.pk,
+                    urls["overpayment"],
+                ),
+                discrepancy=_amount(
+                    money,
+                    "discrepancy",
+                    month_number,
+                    discrepancy,
+                    discrepancy_row and discrepancy_row.pk,
+                    urls["discrepancy"],
+                ),
+                closing_balance=money.grouped(
+                    opening_balance
+                    + interest
+                    + payment
+                    + overpayment
+                    + discrepancy
+                ),
+                extra_cost=_extra_cost(
+                    money,
+                    default_overpayment - overpayment,
+                    row_extra_cost,
+                ),
+            )
+
+        yield month_number, row
+
+
+def iter_ledger_rows(ledger, extra_costs, chunk_months=12):
+    """
+    The rows of the ledger table, `chunk_months` at a time, with each
+    overpayment's entry from `extra_costs` as for `_rows`.
+    """
+    rows = []
+    for _, row in _rows(ledger, extra_costs):
+        rows.append(row)
+
+        if len(rows) == chunk_months:
+            yield "".join(rows)
+            rows = []
+
+    if rows:
+        yield "".join(rows)
+
+
+def ledger_rows(ledger, extra_costs):
+    """
+    All of the rows of the ledger table, with each overpayment's entry from
+    `extra_costs` (as from `Ledger.costs_without_overpayments`).
+    """
+    return mark_safe("".join(iter_ledger_rows(
+        ledger,
+        sorted(extra_costs.items()),
+    )))
+
+
+def summary(ledger):
+    """
+    The values in the detail page's summary, formatted as it shows them.
+    """
+    cost = ledger.calculate_cost()
+    last = ledger.ledger[-1] if ledger.schedule else None
+
+    return {
+        "end_date": month_name(last.year, last.month) if last else "",
+        "total_cost": intcomma(cost),
+        "average_overpayment": floatformat(
+            ledger.average_past_overpayment(),
+            2,
+        ),
+    }
+
+
+def ledger_diff(before, after, months):
+    """
+    What the detail page needs to go from showing `before` to `after`,
+    where the two differ only in overrides at `months`.
+
+    Months before the first of those are the same in both, other than
+    each overpayment's extra cost, which depends on every month after it,
+    so those rows are sent too.  So are the months `after` no longer runs
+    to, and every month there is to speculate on.
+    """
+    before.calculate_entries()
+    after.calculate_entries()
+
+    old = before.schedule
+    new = after.schedule
+
+    months = set(months)
+    months = {
+        month_number
+        for month_number in range(min(months), len(new))
+        if month_number >= len(old)
+        or month_number in months
+        or any(
+            old_column[month_number] != new_column[month_number]
+            for old_column, new_column in zip(old.columns, new.columns)
+        )
+    }
+
+    extra_costs = sorted(after.costs_without_overpayments().items())
+    months.update(
+        month_number
+        for month_number, _ in extra_costs
+        if month_number < len(new)
+    )
+
+    return {
+        "removed": list(range(len(new), len(old))),
+        "rows": dict(_rows(after, extra_costs, months=months)),
+        "summary": summary(after),
+        "month_choices": after.month_choices,
+    }
@@ -0,0 +1,133 @@
+"""
+Throwing away stored ledgers when what went into them changes.
+
+Within a transaction, each mortgage's stored months are thrown away from
+the first month changed, and all of them for an earlier one, rather than
+once for every row saved or deleted (see `LedgerMonthManager`).  Once
+the transaction commits, the mortgage's months are thrown away from the
+earliest month changed once more, which also catches any put back by a
+rolled back savepoint, and its summary is refreshed, once.
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+
+from . import caching
+from .models import (
+    ActualInitialPayment,
+    ActualThereafterPayment,
+    Discrepancy,
+    LedgerMonth,
+    Mortgage,
+    Overpayment,
+    RateChange,
+    transaction_state,
+)
+
+
+# The month a mortgage being deleted, which takes its months with it, is
+# pending from.
+DELETED = -1
+
+
+def pending():
+    """
+    `{mortgage_pk: month}` of the earliest month changed of each mortgage
+    changed in the current transaction, for once it's committed.
+    """
+    return transaction_state(
+        transaction.get_connection(),
+        "pending_ledger_invalidations",
+    )
+
+
+def clear(mortgage_pk, month):
+    caching.invalidate(mortgage_pk)
+    LedgerMonth.objects.invalidate(mortgage_pk, month=month)
+
+
+def refresh_summary(mortgage_pk):
+    mortgage = Mortgage.objects.filter(pk=mortgage_pk).first()
+    if mortgage is not None:
+        mortgage.refresh_summary()
+
+
+def flush(invalidations, mortgage_pk):
+    month = invalidations.pop(mortgage_pk, None)
+    if month is None:
+        # Already done, for an earlier change in the same transaction.
+        return
+
+    with transaction.atomic():
+        # Waits for, and holds off, `Ledger._store`.
+        exists = Mortgage.objects.change_ledger(mortgage_pk)
+        caching.invalidate(mortgage_pk)
+        if not exists:
+            # Deleted, along with its months.
+            return
+
+        LedgerMonth.objects.invalidate(mortgage_pk, month=max(month, 0))
+
+    refresh_summary(mortgage_pk)
+
+
+def invalidate(mortgage_pk, month=0):
+    if not transaction.get_connection().in_atomic_block:
+        # Already committed.
+        Mortgage.objects.change_ledger(mortgage_pk)
+        clear(mortgage_pk, month)
+        refresh_summary(mortgage_pk)
+
+        return
+
+    invalidations = pending()
+    if mortgage_pk not in invalidations:
+        # Held until the change is committed, keeping `Ledger._store` from
+        # storing what was calculated from before it meanwhile.
+        Mortgage.objects.change_ledger(mortgage_pk)
+
+    invalidations[mortgage_pk] = min(
+        month,
+        invalidations.get(mortgage_pk, month),
+    )
+    clear(mortgage_pk, month)
+
+    # Whichever of these runs first does the lot.
+    transaction.on_commit(lambda: flush(invalidations, mortgage_pk))
+
+
+def invalidate_mortgage(sender, instance, **kwargs):
+    invalidate(instance.pk)
+
+
+def invalidate_related_mortgage(sender, instance, **kwargs):
+    invalidate(instance.mortgage_id)
+
+
+def invalidate_amount_month(sender, instance, **kwargs):
+    invalidate(instance.mortgage_id, month=instance.month)
+
+
+def deleting_mortgage(sender, instance, **kwargs):
+    # Nothing to do for the rows that cascade from it.
+    invalidations = pending()
+    invalidations[instance.pk] = DELETED
+    LedgerMonth.objects.deleting(instance.pk)
+
+    transaction.on_commit(lambda: flush(invalidations, instance.pk))
+
+
+def connect():
+    pre_delete.connect(deleting_mortgage, sender=Mortgage)
+
+    for signal in [post_save, post_delete]:
+        signal.connect(invalidate_mortgage, sender=Mortgage)
+
+        for model in [
+            ActualInitialPayment,
+            ActualThereafterPayment,
+            RateChange,
+        ]:
+            signal.connect(invalidate_related_mortgage, sender=model)
+
+        for model in [Discrepancy, Overpayment]:
+            signal.connect(invalidate_amount_month, sender=model)
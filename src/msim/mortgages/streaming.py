@@ -0,0 +1,159 @@
+"""
+Helpers for streamed responses.
+
+Django's own ASGI handler iterates streaming responses on the event loop,
+so a page worked out as it's sent holds up every other request on the
+worker meanwhile, and is worked out to the end even once there's nobody
+left to send it to.  `ASGIHandler` iterates them in `offloading`'s threads
+instead, and stops as soon as the client's gone.
+"""
+import asyncio
+import contextvars
+import threading
+
+from asgiref.sync import sync_to_async
+
+from django.core.handlers import asgi
+from django.db import close_old_connections
+
+from . import offloading
+
+
+_DONE = object()
+
+_receive = contextvars.ContextVar("receive")
+
+
+async def disconnection(receive):
+    """
+    Wait for the client to go, the request itself having been read.
+    """
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def iterate(chunks, receive=None, buffer=16):
+    """
+    Iterate `chunks` in one of `offloading.get_executor()`'s threads, at
+    most `buffer` chunks ahead of whoever's reading them, without holding
+    up the event loop.
+
+    The thread stops early if the client goes, as `receive` says, or
+    this is closed before it's finished.
+    """
+    loop = asyncio.get_event_loop()
+    pending = asyncio.Queue(maxsize=buffer)
+    stopped = threading.Event()
+
+    def put(item):
+        if not stopped.is_set():
+            asyncio.run_coroutine_threadsafe(pending.put(item), loop).result()
+
+    def produce():
+        try:
+            close_old_connections()
+
+            for chunk in chunks:
+                if stopped.is_set():
+                    return
+
+                put((chunk, None))
+
+            put((_DONE, None))
+        except Exception as e:
+            put((_DONE, e))
+        finally:
+            close_old_connections()
+
+    producing = loop.run_in_executor(
+        offloading.get_executor(),
+        contextvars.copy_context().run,
+        produce,
+    )
+    disconnected = asyncio.ensure_future(
+        disconnection(receive) if receive is not None
+        else loop.create_future()
+    )
+
+    try:
+        while True:
+            getting = asyncio.ensure_future(pending.get())
+            await asyncio.wait(
+                [getting, disconnected],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not getting.done():
+                getting.cancel()
+                return
+
+            chunk, error = getting.result()
+            if error is not None:
+                raise error
+
+            if chunk is _DONE:
+                return
+
+            yield chunk
+    finally:
+        stopped.set()
+        disconnected.cancel()
+
+        # Letting the thread past a full queue to see it's been stopped.
+        while not pending.empty():
+            pending.get_nowait()
+
+        await producing
+
+
+class ASGIHandler(asgi.ASGIHandler):
+    """
+    Django's ASGI handler, iterating streaming responses off the event
+    loop, and only for as long as the client's there.
+    """
+
+    async def __call__(self, scope, receive, send):
+        _receive.set(receive)
+
+        await super().__call__(scope, receive, send)
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            await super().send_response(response, send)
+
+            return
+
+        # As Django does.
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode("ascii")
+            if isinstance(value, str):
+                value = value.encode("latin1")
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append((
+                b"Set-Cookie",
+                cookie.output(header="").encode("ascii").strip(),
+            ))
+
+        await send({
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": headers,
+        })
+
+        parts = iterate(iter(response), receive=_receive.get(None))
+        try:
+            async for part in parts:
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": True,
+                    })
+        finally:
+            await parts.aclose()
+
+        await send({"type": "http.response.body"})
+
+        await sync_to_async(response.close, thread_sensitive=True)()
@@ -1,3 +1,54 @@
+const summaryIds = {
+  end_date: 'summaryEndDate',
+  total_cost: 'summaryTotalCost',
+  average_overpayment: 'summaryAverageOverpayment',
+}
+
+function applyLedgerDiff(diff) {
+  const body = document.getElementById('ledgerTable').tBodies[0]
+
+  // The months the ledger no longer runs to, from the last.
+  for (const monthNumber of diff.removed.slice().reverse()) {
+    body.deleteRow(monthNumber)
+  }
+
+  // Integer keys come out in order, so new rows are appended in order.
+  for (const [monthNumber, html] of Object.entries(diff.rows)) {
+    const template = document.createElement('template')
+    template.innerHTML = html.trim()
+    const row = template.content.firstElementChild
+
+    if (monthNumber < body.rows.length) {
+      body.rows[monthNumber].replaceWith(row)
+    } else {
+      body.appendChild(row)
+    }
+  }
+
+  for (const [name, value] of Object.entries(diff.summary)) {
+    document.getElementById(summaryIds[name]).textContent = value
+  }
+
+  setMonthChoices(
+    document.getElementById('speculateForm').elements.month,
+    diff.month_choices,
+  )
+}
+
+function setMonthChoices(select, choices) {
+  const selected = select.value
+
+  select.replaceChildren(...choices.map(
+    ([monthNumber, name]) => new Option(name, monthNumber)
+  ))
+
+  // Staying on the same month, if the ledger still runs to it.
+  select.value = selected
+  if (select.selectedIndex === -1) {
+    select.selectedIndex = 0
+  }
+}
+
 function amountDelete(url) {
   const request = new XMLHttpRequest()
   request.open('POST', url, true)
@@ -7,7 +58,7 @@ function amountDelete(url) {
     const resp = this.response
     if (this.status >= 200 && this.status < 400) {
       // Success!
-      location.reload()
+      applyLedgerDiff(JSON.parse(resp))
     } else {
       // We reached our target server, but it returned an error
       alert("It broke horribly.  Next popup will be whatever ugly results.")
@@ -34,8 +85,7 @@ function amountSave(url, name, monthNumber) {
     const resp = this.response
     if (this.status >= 200 && this.status < 400) {
       // Success!
-      // TODO: Remove this one from GET.
-      location.reload()
+      applyLedgerDiff(JSON.parse(resp))
     } else {
       // We reached our target server, but it returned an error
       alert("It broke horribly.  Next popup will be whatever ugly results.")
@@ -3,17 +3,26 @@ from django.urls import path
 from .views import (
     ActualInitialPaymentSet,
     ActualThereafterPaymentSet,
+    DiscrepancyBulkSet,
     DiscrepancyDelete,
     DiscrepancyCreateUpdate,
+    JobDetail,
+    JobSubmit,
+    LedgerExport,
     MortgageCreate,
     MortgageDelete,
     MortgageDetail,
     MortgageDuplicate,
     MortgageList,
     MortgageUpdate,
+    OptimiseOverpayments,
+    OwnerLedgerExport,
+    OverpaymentBulkSet,
     OverpaymentDelete,
     OverpaymentCreateUpdate,
+    SimulateRates,
     Speculate,
+    SpeculateGrid,
 )
 
 
@@ -23,6 +32,31 @@ urlpatterns = [
     path("create/", MortgageCreate.as_view(), name="create"),
     path("<int:pk>/update/", MortgageUpdate.as_view(), name="update"),
     path("<int:pk>/", MortgageDetail.as_view(), name="detail"),
+    path(
+        "<int:pk>/ledger.csv",
+        LedgerExport.as_view(export_format="csv"),
+        name="export.csv",
+    ),
+    path(
+        "<int:pk>/ledger.jsonl",
+        LedgerExport.as_view(export_format="jsonl"),
+        name="export.jsonl",
+    ),
+    path(
+        "ledgers.csv",
+        OwnerLedgerExport.as_view(export_format="csv"),
+        name="export_all.csv",
+    ),
+    path(
+        "ledgers.jsonl",
+        OwnerLedgerExport.as_view(export_format="jsonl"),
+        name="export_all.jsonl",
+    ),
+    path(
+        "<int:pk>/stream/",
+        MortgageDetail.as_view(stream=True),
+        name="detail.stream",
+    ),
     path(
         "<int:pk>/set_initial/",
         ActualInitialPaymentSet.as_view(),
@@ -40,6 +74,11 @@ urlpatterns = [
         OverpaymentCreateUpdate.as_view(),
         name="overpayment.create_update",
     ),
+    path(
+        "<int:pk>/overpayments/bulk/",
+        OverpaymentBulkSet.as_view(),
+        name="overpayment.bulk_set",
+    ),
     path(
         "overpayments/<int:pk>/delete/",
         OverpaymentDelete.as_view(),
@@ -50,10 +89,36 @@ urlpatterns = [
         DiscrepancyCreateUpdate.as_view(),
         name="discrepancy.create_update",
     ),
+    path(
+        "<int:pk>/discrepancies/bulk/",
+        DiscrepancyBulkSet.as_view(),
+        name="discrepancy.bulk_set",
+    ),
     path(
         "discrepancies/<int:pk>/delete/",
         DiscrepancyDelete.as_view(),
         name="discrepancy.delete",
     ),
-    path("<int:pk>/speculate/", Speculate.as_view(), name="speculate")
+    path(
+        "<int:pk>/jobs/<slug:kind>/",
+        JobSubmit.as_view(),
+        name="job.submit",
+    ),
+    path("jobs/<int:pk>/", JobDetail.as_view(), name="job"),
+    path("<int:pk>/speculate/", Speculate.as_view(), name="speculate"),
+    path(
+        "<int:pk>/simulate_rates/",
+        SimulateRates.as_view(),
+        name="simulate_rates",
+    ),
+    path(
+        "<int:pk>/optimise/",
+        OptimiseOverpayments.as_view(),
+        name="optimise",
+    ),
+    path(
+        "<int:pk>/speculate/grid/",
+        SpeculateGrid.as_view(),
+        name="speculate.grid",
+    ),
 ]
@@ -1,4 +1,28 @@
+from calendar import monthrange
+import datetime
+
+
 def payment(interest_rate, period_count, principal):
     j = (interest_rate + 1) ** period_count
 
     return round(principal * ((interest_rate * j) / (j - 1)), 2)
+
+
+def add_months(year, month, count):
+    month_index = month - 1 + count
+
+    return {"year": year + month_index // 12, "month": month_index % 12 + 1}
+
+
+def add_months_to_date(date, count):
+    """
+    Clamped to the end of shorter months, as Postgres does.
+    """
+    added = add_months(date.year, date.month, count)
+    day = min(date.day, monthrange(added["year"], added["month"])[1])
+
+    return datetime.date(day=day, **added)
+
+
+def month_name(year, month):
+    return f"{year}-{month:02d}"
@@ -1,10 +1,20 @@
-from copy import deepcopy
 import json
 
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.core.exceptions import ImproperlyConfigured
-from django.http import HttpResponse, HttpResponseRedirect
-from django.urls import reverse_lazy
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseRedirect,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.template.loader import render_to_string
+from django.urls import reverse, reverse_lazy
+from django.utils.crypto import constant_time_compare
+from django.utils.safestring import mark_safe
+from django.utils.text import compress_sequence
 from django.views.generic import (
     CreateView,
     DeleteView,
@@ -12,20 +22,41 @@ from django.views.generic import (
     FormView,
     ListView,
     UpdateView,
+    View,
 )
 from django.views.generic.detail import SingleObjectMixin
 
-from . import forms
+from . import (
+    exports,
+    forms,
+    jobs,
+    metrics,
+    offloading,
+    rendering,
+    utils,
+)
 from .models import (
     ActualInitialPayment,
     ActualThereafterPayment,
     Discrepancy,
+    Job,
     Ledger,
     Mortgage,
     Overpayment,
 )
 
 
+class OffloadedMixin:
+    """
+    Served as an async view, calculating away from the event loop and the
+    thread the rest of the sync views share.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return offloading.offloaded(super().as_view(**initkwargs))
+
+
 class MortgageCreateUpdateMixin:
     model = Mortgage
     fields = [
@@ -71,45 +102,190 @@ class MortgageUpdate(
 
 class MortgageList(LoginRequiredMixin, OwnerMixin, ListView):
     model = Mortgage
+    orderings = {
+        "payoff_date": "Paid off",
+        "total_cost": "Total cost",
+        "total_interest": "Total interest",
+        "next_month_balance": "Next month's balance",
+    }
+
+    def get_queryset(self):
+        queryset = super().get_queryset().with_next_month_balance()
 
+        # Mortgages from before summaries were kept, the first time they're
+        # listed, so they can be ordered with the rest.
+        unsummarised = [
+            mortgage
+            for mortgage in queryset
+            if mortgage.total_cost is None
+        ]
+        if not unsummarised:
+            return queryset
 
-class MortgageDetail(LoginRequiredMixin, OwnerMixin, DetailView):
+        for mortgage in unsummarised:
+            mortgage.refresh_summary()
+
+        return queryset.all()
+
+    def get_ordering(self):
+        ordering = self.request.GET.get("order", "")
+        if ordering.lstrip("-") not in self.orderings:
+            return None
+
+        return ordering
+
+    def get_context_data(self, **kwargs):
+        return {
+            **super().get_context_data(**kwargs),
+            "ordering": self.get_ordering(),
+            "summary_headings": self.orderings.items(),
+        }
+
+
+# Where the streamed parts of the detail page go.
+STREAMED_SUMMARY = mark_safe("<!-- summary -->")
+STREAMED_LEDGER_ROWS = mark_safe("<!-- ledger rows -->")
+
+
+class MortgageDetail(
+    OffloadedMixin,
+    LoginRequiredMixin,
+    OwnerMixin,
+    DetailView,
+):
     model = Mortgage
+    summary_template_name = "mortgages/_mortgage_detail_summary.html"
+    # Send the page in pieces, with the ledger rows as they're calculated.
+    stream = False
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        ledger = Ledger(mortgage=self.object)
-        cost = ledger.calculate_cost()
-
-        without_overriden_overpayments = {}
-        for month in ledger.overpayments:
-            without_overridden_overpayment = deepcopy(ledger)
-            without_overridden_overpayment.delete_overpayment(month)
-            cost_without_overpayment = (
-                without_overridden_overpayment.calculate_cost()
-            )
+        self.ledger = Ledger(mortgage=self.object)
 
-            # Positive for greater total cost.
-            without_overriden_overpayments[month] = (
-                cost_without_overpayment - cost
-            )
+        if self.stream:
+            return {
+                **context,
+                "summary": STREAMED_SUMMARY,
+                "ledger_rows": STREAMED_LEDGER_ROWS,
+            }
 
         return {
             **context,
-            "ledger": ledger.ledger,
-            "total_cost": cost,
-            "average_overpayment": (
-                self.object.overpayments
-                .in_the_past()
-                .average()
+            "summary": self.render_summary(),
+            "ledger_rows": rendering.ledger_rows(
+                self.ledger,
+                self.ledger.costs_without_overpayments(),
             ),
-            "what_could_have_been": without_overriden_overpayments,
+        }
+
+    def get_summary_context_data(self):
+        ledger = self.ledger
+
+        return {
+            "mortgage": self.object,
+            "ledger": ledger.ledger,
+            "total_cost": ledger.calculate_cost(),
+            "average_overpayment": ledger.average_past_overpayment(),
             "speculate_form": forms.SpeculateForm(
                 month_choices=ledger.month_choices,
-            )
+            ),
+            "speculate_grid_form": forms.SpeculateGridForm(),
+            "optimise_form": forms.OptimiseForm(),
+            "simulate_rates_form": forms.SimulateRatesForm(),
         }
 
+    def render_summary(self):
+        return render_to_string(
+            self.summary_template_name,
+            self.get_summary_context_data(),
+        )
+
+    def render_to_response(self, context, **response_kwargs):
+        if not self.stream:
+            return super().render_to_response(context, **response_kwargs)
+
+        page = render_to_string(
+            self.get_template_names(),
+            context,
+            request=self.request,
+        )
+        head, rest = page.split(STREAMED_SUMMARY)
+        middle, tail = rest.split(STREAMED_LEDGER_ROWS)
+
+        return StreamingHttpResponse(
+            self.stream_page(head, middle, tail),
+            **response_kwargs,
+        )
+
+    def stream_page(self, head, middle, tail):
+        yield head
+        yield self.render_summary()
+        yield middle
+        yield from rendering.iter_ledger_rows(
+            self.ledger,
+            self.ledger.iter_costs_without_overpayments(),
+        )
+        yield tail
+
+
+class LedgerExportMixin:
+    export_format = None
+
+    def export_response(self, rows, filename):
+        if self.export_format not in exports.FORMATTERS:
+            raise ImproperlyConfigured("no")
+
+        chunks = exports.FORMATTERS[self.export_format](rows)
+        content_type = exports.CONTENT_TYPES[self.export_format]
+        filename = f"{filename}.{self.export_format}"
+
+        if self.request.GET.get("gzip"):
+            chunks = compress_sequence(chunk.encode() for chunk in chunks)
+            content_type = "application/gzip"
+            filename = f"{filename}.gz"
+
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+
+        return response
+
+
+class LedgerExport(
+    OffloadedMixin,
+    LoginRequiredMixin,
+    OwnerMixin,
+    LedgerExportMixin,
+    SingleObjectMixin,
+    View,
+):
+    model = Mortgage
+
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+
+        ledger = Ledger(mortgage=self.object)
+
+        return self.export_response(
+            exports.iter_ledger_rows(ledger),
+            filename=f"mortgage-{self.object.pk}",
+        )
+
+
+class OwnerLedgerExport(LoginRequiredMixin, LedgerExportMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        ledgers = Mortgage.objects.owned_by(request.user).iter_ledgers()
+
+        return self.export_response(
+            (
+                row
+                for ledger in ledgers
+                for row in exports.iter_ledger_rows(ledger)
+            ),
+            filename="mortgages",
+        )
+
 
 class ActualPaymentSet(
     LoginRequiredMixin,
@@ -173,9 +349,11 @@ class MortgageDuplicate(
         }
 
     def form_valid(self, form):
-        mortgage = form.save()
+        duplicates = form.save()
+        if len(duplicates) > 1:
+            return HttpResponseRedirect(reverse("mortgages:list"))
 
-        return HttpResponseRedirect(mortgage.get_absolute_url())
+        return HttpResponseRedirect(duplicates[0].get_absolute_url())
 
 
 class MortgageDelete(LoginRequiredMixin, OwnerMixin, DeleteView):
@@ -189,15 +367,31 @@ class AmountOwnerMixin:
         return super().get_queryset().owned_by(self.request.user)
 
 
-class BaseAmountCreateUpdate(LoginRequiredMixin, AmountOwnerMixin, FormView):
+class BaseAmountCreateUpdate(
+    OffloadedMixin,
+    LoginRequiredMixin,
+    AmountOwnerMixin,
+    FormView,
+):
     form_class = forms.AmountCreateUpdate
 
     def form_valid(self, form):
-        form.save()
+        before = Ledger(mortgage=form.cleaned_data["mortgage"])
+        before.calculate_entries()
+
+        after = form.save()
 
-        return HttpResponse(status=204)
+        return JsonResponse(rendering.ledger_diff(
+            before,
+            after,
+            months=[form.cleaned_data["month"]],
+        ))
 
     def form_invalid(self, form):
+        if "mortgage" in form.errors:
+            # Someone else's, as far as anyone else needs to know.
+            raise Http404("No such mortgage.")
+
         return HttpResponse(
             json.dumps(form.errors).encode("utf-8"),
             status=400,
@@ -208,6 +402,7 @@ class BaseAmountCreateUpdate(LoginRequiredMixin, AmountOwnerMixin, FormView):
         kwargs = {
             **super().get_form_kwargs(),
             "model": self.model,
+            "user": self.request.user,
         }
 
         if "data" in kwargs:
@@ -217,10 +412,86 @@ class BaseAmountCreateUpdate(LoginRequiredMixin, AmountOwnerMixin, FormView):
         return kwargs
 
 
-class DiscrepancyDelete(LoginRequiredMixin, AmountOwnerMixin, DeleteView):
-    model = Discrepancy
+class BaseAmountBulkSet(
+    OffloadedMixin,
+    LoginRequiredMixin,
+    OwnerMixin,
+    SingleObjectMixin,
+    FormView,
+):
+    """
+    Set or delete many months' amounts at once, from a JSON body of
+    `{month: amount}`.
+    """
+    model = Mortgage
+    form_class = forms.AmountBulkSet
+    http_method_names = ["post"]
+    amount_model = None
+
+    def get_form_kwargs(self):
+        if self.amount_model is None:
+            raise ImproperlyConfigured("no")
+
+        self.object = self.get_object()
+
+        return {
+            **super().get_form_kwargs(),
+            "data": {"amounts": self.request.body.decode("utf-8")},
+            "model": self.amount_model,
+            "mortgage": self.object,
+        }
+
+    def form_valid(self, form):
+        before = Ledger(mortgage=self.object)
+        before.calculate_entries()
+
+        after = form.save()
+
+        return JsonResponse(rendering.ledger_diff(
+            before,
+            after,
+            months=form.cleaned_data["amounts"],
+        ))
+
+    def form_invalid(self, form):
+        return JsonResponse(form.errors, status=400)
+
+
+class DiscrepancyBulkSet(BaseAmountBulkSet):
+    amount_model = Discrepancy
+
+
+class OverpaymentBulkSet(BaseAmountBulkSet):
+    amount_model = Overpayment
+
+
+class BaseAmountDelete(
+    OffloadedMixin,
+    LoginRequiredMixin,
+    AmountOwnerMixin,
+    DeleteView,
+):
     success_url = reverse_lazy("mortgages:list")
 
+    def delete(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        mortgage = self.object.mortgage
+
+        before = Ledger(mortgage=mortgage)
+        before.calculate_entries()
+
+        self.object.delete()
+
+        return JsonResponse(rendering.ledger_diff(
+            before,
+            Ledger(mortgage=mortgage),
+            months=[self.object.month],
+        ))
+
+
+class DiscrepancyDelete(BaseAmountDelete):
+    model = Discrepancy
+
 
 class DiscrepancyCreateUpdate(BaseAmountCreateUpdate):
     model = Discrepancy
@@ -228,9 +499,8 @@ class DiscrepancyCreateUpdate(BaseAmountCreateUpdate):
     fields = ["amount"]
 
 
-class OverpaymentDelete(LoginRequiredMixin, AmountOwnerMixin, DeleteView):
+class OverpaymentDelete(BaseAmountDelete):
     model = Overpayment
-    success_url = reverse_lazy("mortgages:list")
 
 
 class OverpaymentCreateUpdate(BaseAmountCreateUpdate):
@@ -238,7 +508,68 @@ class OverpaymentCreateUpdate(BaseAmountCreateUpdate):
     success_url = reverse_lazy("mortgages:list")
 
 
-class Speculate(LoginRequiredMixin, OwnerMixin, DetailView):
+class JobSubmit(LoginRequiredMixin, OwnerMixin, SingleObjectMixin, View):
+    """
+    Queue one of `jobs.KINDS` for the mortgage, from the kind's form.
+    """
+    model = Mortgage
+
+    def post(self, request, *args, **kwargs):
+        self.object = self.get_object()
+
+        kind = jobs.KINDS.get(self.kwargs["kind"])
+        if kind is None:
+            raise Http404("No such kind of job.")
+
+        form = kind.form_class(request.POST)
+        if not form.is_valid():
+            return JsonResponse(form.errors, status=400)
+
+        job = jobs.submit(
+            self.object,
+            self.kwargs["kind"],
+            jobs.parameters(form),
+        )
+
+        return JsonResponse(
+            job.as_dict(),
+            status=200 if job.status == Job.DONE else 202,
+        )
+
+
+class JobDetail(LoginRequiredMixin, OwnerMixin, DetailView):
+    model = Job
+
+    def render_to_response(self, context, **response_kwargs):
+        return JsonResponse(self.object.as_dict(), **response_kwargs)
+
+
+class Metrics(View):
+    """
+    This process' `metrics.registry`, for Prometheus to scrape, with
+    `METRICS_TOKEN` as a bearer token, or for staff to look at.
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not (request.user.is_staff or self.has_token(request)):
+            raise PermissionDenied
+
+        return HttpResponse(
+            metrics.registry.as_text(),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+    def has_token(self, request):
+        if not settings.METRICS_TOKEN:
+            return False
+
+        return constant_time_compare(
+            request.META.get("HTTP_AUTHORIZATION", ""),
+            f"Bearer {settings.METRICS_TOKEN}",
+        )
+
+
+class Speculate(OffloadedMixin, LoginRequiredMixin, OwnerMixin, DetailView):
     model = Mortgage
     template_name_suffix = "_speculate"
 
@@ -255,35 +586,150 @@ class Speculate(LoginRequiredMixin, OwnerMixin, DetailView):
         data = None
         no_money = False
         if valid:
-            base_cost = ledger.calculate_cost()
-
             data = form.cleaned_data
-            remaining = data['amount']
-            month = data['month']
-            while remaining > 0:
-                overpayment = ledger.ledger[month].overpayment
-                ledger.set_overpayment(
-                    month,
-                    Overpayment(amount=max(overpayment - remaining, 0)),
+            delta, no_money = ledger.speculate(data['amount'], data['month'])
+
+        return {
+            **super().get_context_data(**kwargs),
+            "valid": valid,
+            "form": form,
+            "delta": delta,
+            "data": data,
+            "no_money": no_money,
+            "month_names": dict(month_choices),
+        }
+
+
+class OptimiseOverpayments(
+    OffloadedMixin,
+    LoginRequiredMixin,
+    OwnerMixin,
+    DetailView,
+):
+    model = Mortgage
+    template_name_suffix = "_optimise"
+
+    def get_context_data(self, **kwargs):
+        form = forms.OptimiseForm(self.request.GET)
+        valid = form.is_valid()
+
+        cost = None
+        optimised_cost = None
+        overpayments = None
+        if valid:
+            ledger = Ledger(self.object)
+            cost = ledger.calculate_cost()
+            optimised, optimised_cost = ledger.optimise_overpayments(
+                form.cleaned_data["budget"],
+            )
+
+            start_date = self.object.start_date
+            overpayments = [
+                (
+                    utils.month_name(**utils.add_months(
+                        start_date.year,
+                        start_date.month,
+                        month,
+                    )),
+                    overpayment,
                 )
-                remaining -= overpayment
-                month -= 1
+                for month, overpayment in sorted(optimised.items())
+            ]
+
+        return {
+            **super().get_context_data(**kwargs),
+            "valid": valid,
+            "form": form,
+            "cost": cost,
+            "optimised_cost": optimised_cost,
+            "overpayments": overpayments,
+        }
 
-                if month < 0:
-                    no_money = True
 
-                    break
+class SimulateRates(
+    OffloadedMixin,
+    LoginRequiredMixin,
+    OwnerMixin,
+    DetailView,
+):
+    model = Mortgage
+    template_name_suffix = "_simulate_rates"
 
-            new_cost = ledger.calculate_cost()
+    def get_context_data(self, **kwargs):
+        form = forms.SimulateRatesForm(self.request.GET)
+        valid = form.is_valid()
 
-            delta = base_cost - new_cost + data['amount']
+        summary = None
+        if valid:
+            data = form.cleaned_data
+            summary = Ledger(self.object).simulate_rates(
+                paths=data["paths"],
+                drift=float(data["drift"]),
+                volatility=float(data["volatility"]),
+                seed=data["seed"],
+            )
 
         return {
             **super().get_context_data(**kwargs),
             "valid": valid,
             "form": form,
-            "delta": delta,
-            "data": data,
-            "no_money": no_money,
-            "month_names": dict(month_choices),
+            "summary": summary,
+        }
+
+
+class SpeculateGrid(
+    OffloadedMixin,
+    LoginRequiredMixin,
+    OwnerMixin,
+    DetailView,
+):
+    model = Mortgage
+    template_name_suffix = "_speculate_grid"
+
+    def get_context_data(self, **kwargs):
+        form = forms.SpeculateGridForm(self.request.GET)
+        valid = form.is_valid()
+
+        rows = None
+        amounts = None
+        if valid:
+            ledger = Ledger(self.object)
+            month_choices = ledger.month_choices
+            amounts = form.cleaned_data["amounts"]
+            grid = ledger.speculation_grid(
+                amounts=amounts,
+                months=[month for month, _ in month_choices],
+            )
+
+            hottest = max(
+                [delta for delta, no_money in grid.values() if not no_money],
+                default=0,
+            )
+
+            rows = []
+            for month, month_name in month_choices:
+                cells = []
+                for amount in amounts:
+                    delta, no_money = grid[amount, month]
+
+                    # 100 (white) for free, down to 50 (red) for the most
+                    # expensive.
+                    lightness = 100
+                    if hottest > 0:
+                        lightness -= round(50 * max(delta, 0) / hottest)
+
+                    cells.append({
+                        "delta": delta,
+                        "no_money": no_money,
+                        "lightness": lightness,
+                    })
+
+                rows.append({"month_name": month_name, "cells": cells})
+
+        return {
+            **super().get_context_data(**kwargs),
+            "valid": valid,
+            "form": form,
+            "amounts": amounts,
+            "rows": rows,
         }
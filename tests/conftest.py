@@ -0,0 +1,121 @@
+import json
+from pathlib import Path
+import time
+
+import pytest
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("benchmark")
+    group.addoption(
+        "--benchmark",
+        action="store_true",
+        help="run the benchmarks, which are skipped otherwise",
+    )
+    group.addoption(
+        "--benchmark-save",
+        action="store_true",
+        help="record the timings as the new baseline, rather than comparing",
+    )
+    group.addoption(
+        "--benchmark-baseline",
+        default=str(Path(__file__).with_name("benchmarks.json")),
+        help="the file of baseline timings",
+    )
+    group.addoption(
+        "--benchmark-threshold",
+        type=float,
+        default=0.5,
+        help="how much slower than the baseline fails (0.5 = 50%%)",
+    )
+    group.addoption(
+        "--benchmark-repeat",
+        type=int,
+        default=5,
+        help="times to run each benchmark, keeping the fastest",
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers",
+        "benchmark: a timing, only run with --benchmark",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+
+    skip = pytest.mark.skip(reason="benchmarks need --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+@pytest.fixture(scope="session")
+def benchmark_results(request):
+    """
+    Every benchmark's best time this run, by test id.  Saved over the
+    baseline at the end with `--benchmark-save`.
+    """
+    results = {}
+
+    yield results
+
+    if request.config.getoption("--benchmark-save") and results:
+        path = request.config.getoption("--benchmark-baseline")
+        baseline = {**load_baseline(path), **results}
+        with open(path, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+
+@pytest.fixture
+def benchmark(request, benchmark_results):
+    """
+    `benchmark(run, setup=None)` times `run()`, calling `setup()` untimed
+    before each go, and fails if the fastest is too far behind the
+    baseline.
+    """
+    config = request.config
+    name = request.node.nodeid.split("::")[-1]
+    repeat = config.getoption("--benchmark-repeat")
+    threshold = config.getoption("--benchmark-threshold")
+    expected = None
+    if not config.getoption("--benchmark-save"):
+        expected = load_baseline(
+            config.getoption("--benchmark-baseline"),
+        ).get(name)
+
+    def time_it(run, setup=None):
+        timings = []
+        # The first go, untimed, to load templates and warm caches.
+        for _ in range(repeat + 1):
+            if setup is not None:
+                setup()
+
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+
+        best = min(timings[1:])
+        benchmark_results[name] = best
+
+        if expected is not None and best > expected * (1 + threshold):
+            pytest.fail(
+                f"{name} took {best:.4f}s, more than {threshold:.0%} over"
+                f" its baseline of {expected:.4f}s",
+            )
+
+        return best
+
+    return time_it
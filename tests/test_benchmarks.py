@@ -0,0 +1,125 @@
+"""
+Timings of calculating ledgers, and of the pages that do, for synthetic
+mortgages of a range of sizes.
+
+Only run with `pytest --benchmark`.  Record a baseline on your machine with
+`--benchmark-save` first; after that, anything more than
+`--benchmark-threshold` slower than it fails.
+"""
+import datetime
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+
+import pytest
+
+from mortgages import caching
+from mortgages.models import Discrepancy, Ledger, LedgerMonth, Mortgage
+from mortgages.models import Overpayment, RateChange
+
+
+pytestmark = pytest.mark.benchmark
+
+SCENARIOS = [
+    (years, overrides)
+    for years in [25, 35, 40]
+    for overrides in [0, 50, 400]
+]
+
+
+@pytest.fixture(
+    params=SCENARIOS,
+    ids=[f"{years}y-{overrides}" for years, overrides in SCENARIOS],
+)
+def synthetic_mortgage(request, db):
+    years, overrides = request.param
+    term = years * 12
+    caching.get_cache().clear()
+
+    owner = get_user_model().objects.create_user(username="owner")
+    mortgage = Mortgage.objects.create(
+        owner=owner,
+        start_date=datetime.date(2020, 5, 1),
+        amount=Decimal("300000.00"),
+        term=term,
+        initial_period=24,
+        interest_rate_initial=Decimal("0.01840"),
+        interest_rate_thereafter=Decimal("0.04190"),
+        income=Decimal("4000.00"),
+        expenditure=Decimal("2000.00"),
+        # So it runs to the end of its term.
+        default_overpayment_initial=Decimal("0"),
+        default_overpayment_thereafter=Decimal("0"),
+    )
+
+    # A period every five years after the initial one.
+    for start_month in range(60, term, 60):
+        RateChange.objects.create(
+            mortgage=mortgage,
+            start_month=start_month,
+            interest_rate=Decimal("0.03") + Decimal(start_month) / 100000,
+        )
+
+    # Half of each, spread over the term.
+    months = [
+        month * term // (overrides // 2)
+        for month in range(overrides // 2)
+    ]
+    Overpayment.objects.bulk_set(mortgage, {
+        month: Decimal("50.00") for month in months
+    })
+    Discrepancy.objects.bulk_set(mortgage, {
+        month + 1: Decimal("-5.00") for month in months
+    })
+
+    return Mortgage.objects.get(pk=mortgage.pk)
+
+
+def forget(mortgage):
+    """
+    Throw away everything stored about `mortgage`'s ledger.
+    """
+    caching.get_cache().clear()
+    LedgerMonth.objects.for_mortgage(mortgage).delete()
+
+
+def test_calculate_cost(synthetic_mortgage, benchmark):
+    benchmark(
+        lambda: Ledger(mortgage=synthetic_mortgage).calculate_cost(),
+        setup=lambda: forget(synthetic_mortgage),
+    )
+
+
+def test_month_choices(synthetic_mortgage, benchmark):
+    Ledger(mortgage=synthetic_mortgage).calculate_cost()
+
+    def run():
+        # Too quick to time once.
+        for _ in range(100):
+            Ledger(mortgage=synthetic_mortgage).month_choices
+
+    benchmark(run)
+
+
+def test_detail(synthetic_mortgage, client, benchmark):
+    client.force_login(synthetic_mortgage.owner)
+    url = f"/mortgages/{synthetic_mortgage.pk}/"
+
+    def get():
+        assert client.get(url).status_code == 200
+
+    benchmark(get, setup=lambda: forget(synthetic_mortgage))
+
+
+def test_speculate(synthetic_mortgage, client, benchmark):
+    client.force_login(synthetic_mortgage.owner)
+    url = (
+        f"/mortgages/{synthetic_mortgage.pk}/speculate/"
+        "?amount=1000&month=100"
+    )
+    client.get(url)
+
+    def get():
+        assert client.get(url).status_code == 200
+
+    benchmark(get)
@@ -1,7 +1,125 @@
+import asyncio
+from copy import deepcopy
+import csv
+import datetime
 from decimal import Decimal
+import gzip
+import json
+import re
+import threading
+import time
 
-from mortgages.models import LedgerEntry
-from mortgages.utils import payment
+from asgiref.sync import async_to_sync
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import request_finished
+from django.db import close_old_connections, connection, transaction
+from django.template import Template, engines
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import pytest
+
+from _.asgi import application
+from mortgages import (
+    caching,
+    jobs,
+    metrics,
+    montecarlo,
+    rendering,
+    signals,
+    streaming,
+)
+from mortgages.forms import AmountCreateUpdate
+from mortgages.models import ActualInitialPayment, Discrepancy, Job, Ledger
+from mortgages.models import LedgerEntry, LedgerMonth, Mortgage, Overpayment
+from mortgages.models import RateChange, ledger_input_rows
+from mortgages.utils import add_months, add_months_to_date, payment
+
+
+@pytest.fixture
+def mortgage(db):
+    owner = get_user_model().objects.create_user(username="owner")
+    mortgage = Mortgage.objects.create(
+        owner=owner,
+        start_date=datetime.date(2020, 5, 1),
+        amount=Decimal("156000.00"),
+        term=180,
+        initial_period=24,
+        interest_rate_initial=Decimal("0.01840"),
+        interest_rate_thereafter=Decimal("0.04190"),
+        income=Decimal("3000.00"),
+        expenditure=Decimal("1500.00"),
+    )
+
+    for month, amount in [(0, "0"), (3, "250.55"), (30, "10000"), (40, "5")]:
+        Overpayment.objects.create(
+            mortgage=mortgage,
+            month=month,
+            amount=Decimal(amount),
+        )
+
+    for month, amount in [(2, "-12.34"), (24, "99.99")]:
+        Discrepancy.objects.create(
+            mortgage=mortgage,
+            month=month,
+            amount=Decimal(amount),
+        )
+
+    # As a request would read it, once its overrides have moved its
+    # `ledger_version` on.
+    return Mortgage.objects.get(pk=mortgage.pk)
+
+
+def calculate_reference(mortgage):
+    """
+    The ledger, calculated the long way round in `Decimal`s.
+    """
+    periods = mortgage.as_periods()
+    overpayments = Overpayment.objects.for_mortgage(mortgage).as_monthly_dict()
+    discrepancies = (
+        Discrepancy.objects.for_mortgage(mortgage).as_monthly_dict()
+    )
+
+    entries = []
+    balance = -mortgage.amount
+    while balance != 0:
+        month_number = len(entries)
+        period = periods.get_period(month_number)
+
+        entry = LedgerEntry(
+            month_number=month_number,
+            mortgage_pk=mortgage.pk,
+            **add_months(
+                mortgage.start_date.year,
+                mortgage.start_date.month,
+                month_number,
+            ),
+            opening_balance=balance,
+            interest=round(balance * period.interest_rate / 12, 2),
+            payment=period.payment,
+            overpayment=period.default_overpayment,
+            discrepancy=Decimal("0"),
+        )
+
+        overpayment = overpayments.get(month_number)
+        if overpayment is not None:
+            entry.overpayment = overpayment.amount
+            entry.overpayment_pk = overpayment.pk
+
+        discrepancy = discrepancies.get(month_number)
+        if discrepancy is not None:
+            entry.discrepancy = discrepancy.amount
+            entry.discrepancy_pk = discrepancy.pk
+
+        entry.normalise()
+
+        entries.append(entry)
+        balance = entry.closing_balance
+
+    return entries
 
 
 def test_server_starts(client):
@@ -28,3 +146,1319 @@ def test_ledgerentry_normalise():
     entry.normalise()
 
     assert 0 <= entry.overpayment
+
+
+def test_ledger_matches_reference(mortgage):
+    expected = calculate_reference(mortgage)
+    ledger = Ledger(mortgage=mortgage)
+
+    assert ledger.calculate_cost() == sum(
+        entry.interest + entry.discrepancy for entry in expected
+    )
+    assert ledger.ledger == expected
+
+
+def test_ledger_calculate_entry(mortgage):
+    expected = Ledger(mortgage=mortgage)
+    expected.calculate_entries()
+
+    ledger = Ledger(mortgage=mortgage)
+    while not ledger.complete:
+        ledger.calculate_entry()
+
+    assert ledger.ledger == expected.ledger
+
+
+def test_ledger_costs_without_overrides(mortgage):
+    ledger = Ledger(mortgage=mortgage)
+    cost = ledger.calculate_cost()
+
+    def expected(delete, months):
+        costs = {}
+        for month in months:
+            without = deepcopy(ledger)
+            delete(without, month)
+            costs[month] = without.calculate_cost() - cost
+
+        return costs
+
+    assert ledger.costs_without_overpayments() == expected(
+        Ledger.delete_overpayment,
+        ledger.overpayments,
+    )
+    assert ledger.costs_without_discrepancies() == expected(
+        Ledger.delete_discrepancy,
+        ledger.discrepancies,
+    )
+
+
+def test_ledger_rate_changes(mortgage):
+    for start_month, interest_rate in [
+        (36, "0.03500"),
+        (37, "0.03600"),
+        (60, "0.02000"),
+        (24, "0.05000"),  # Replaces `interest_rate_thereafter`.
+    ]:
+        RateChange.objects.create(
+            mortgage=mortgage,
+            start_month=start_month,
+            interest_rate=Decimal(interest_rate),
+        )
+
+    periods = mortgage.as_periods()
+    assert [period.start_month for period in periods.periods] == [
+        0, 24, 36, 37, 60,
+    ]
+    assert periods.get_period(23).start_month == 0
+    assert periods.get_period(36).interest_rate == Decimal("0.035")
+    assert periods.get_period(59).start_month == 37
+    assert periods.get_period(1000).start_month == 60
+
+    expected = calculate_reference(mortgage)
+    ledger = Ledger(mortgage=mortgage)
+
+    assert ledger.calculate_cost() == sum(
+        entry.interest + entry.discrepancy for entry in expected
+    )
+    assert ledger.ledger == expected
+
+
+def test_ledger_no_initial_period(mortgage):
+    mortgage.initial_period = 0
+    mortgage.save()
+
+    periods = mortgage.as_periods()
+    assert [period.start_month for period in periods.periods] == [0]
+    assert periods.get_period(0).interest_rate == Decimal("0.04190")
+    assert periods.get_period(0).payment == mortgage.default_payment_thereafter
+
+    expected = calculate_reference(mortgage)
+    ledger = Ledger(mortgage=mortgage)
+    ledger.calculate_entries()
+    assert ledger.ledger == expected
+    assert expected[0].interest == round(
+        -mortgage.amount * Decimal("0.04190") / 12,
+        2,
+    )
+
+
+@pytest.fixture
+def shared_ledger_cache(settings, tmp_path):
+    """
+    A `ledgers` cache every process could share, which keeps pointers.
+    """
+    settings.CACHES = {
+        **settings.CACHES,
+        "ledgers": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": str(tmp_path / "ledgers"),
+            "TIMEOUT": None,
+        },
+    }
+    assert caching.is_shared()
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_ledger_cache_invalidation(mortgage, shared, request):
+    if shared:
+        request.getfixturevalue("shared_ledger_cache")
+
+    Ledger(mortgage=mortgage).calculate_cost()
+    pointer = caching.get_cache().get(caching.mortgage_key(mortgage.pk))
+    assert (pointer is not None) == shared
+
+    overpayment = Overpayment.objects.get(mortgage=mortgage, month=30)
+    overpayment.amount = Decimal("20000")
+    overpayment.save()
+
+    assert Ledger(mortgage=mortgage).calculate_cost() == sum(
+        entry.interest + entry.discrepancy
+        for entry in calculate_reference(mortgage)
+    )
+
+    Discrepancy.objects.filter(mortgage=mortgage, month=2).delete()
+
+    assert Ledger(mortgage=mortgage).calculate_cost() == sum(
+        entry.interest + entry.discrepancy
+        for entry in calculate_reference(mortgage)
+    )
+
+
+def test_ledger_store_race(
+    mortgage,
+    transactional_db,
+    shared_ledger_cache,
+    monkeypatch,
+):
+    # As stored by the summaries refreshed as it was set up.
+    caching.get_cache().clear()
+    LedgerMonth.objects.for_mortgage(mortgage).delete()
+    # Which would store the ledger after the change itself.
+    monkeypatch.setattr(signals, "refresh_summary", lambda mortgage_pk: None)
+    simulate = Ledger._simulate
+
+    def simulate_then_change(self, *args, **kwargs):
+        simulate(self, *args, **kwargs)
+
+        # Someone else saving a change after this read the inputs.
+        monkeypatch.setattr(Ledger, "_simulate", simulate)
+        Overpayment.objects.filter(mortgage=mortgage, month=30).update(
+            amount=Decimal("20000"),
+        )
+        signals.invalidate(mortgage.pk, month=30)
+
+    monkeypatch.setattr(Ledger, "_simulate", simulate_then_change)
+    stale = Ledger(mortgage=mortgage).calculate_cost()
+
+    # What was calculated from before the change wasn't kept.
+    assert not LedgerMonth.objects.for_mortgage(mortgage).exists()
+    assert caching.get_cache().get(caching.mortgage_key(mortgage.pk)) is None
+
+    expected = sum(
+        entry.interest + entry.discrepancy
+        for entry in calculate_reference(mortgage)
+    )
+    assert stale != expected
+
+    # Read again, as the next request would, it's kept.
+    mortgage = Mortgage.objects.get(pk=mortgage.pk)
+    assert Ledger(mortgage=mortgage).calculate_cost() == expected
+    assert LedgerMonth.objects.for_mortgage(mortgage).exists()
+
+
+def test_ledger_invalidation_batches(
+    mortgage,
+    transactional_db,
+    django_assert_max_num_queries,
+):
+    Overpayment.objects.bulk_set(mortgage, {
+        month: Decimal("1.00") for month in range(50, 450)
+    })
+    Ledger(mortgage=mortgage).calculate_cost()
+
+    # Once for the lot, rather than for each, then once more when it's
+    # committed, along with the summary.
+    with django_assert_max_num_queries(20):
+        Overpayment.objects.filter(
+            mortgage=mortgage,
+            month__gte=50,
+        ).delete()
+
+    expected = sum(
+        entry.interest + entry.discrepancy
+        for entry in calculate_reference(mortgage)
+    )
+    assert Ledger(mortgage=mortgage).calculate_cost() == expected
+    assert Mortgage.objects.get(pk=mortgage.pk).total_cost == expected
+
+    # And nothing at all for what cascades from a mortgage.
+    Overpayment.objects.bulk_set(mortgage, {
+        month: Decimal("1.00") for month in range(50, 450)
+    })
+    with django_assert_max_num_queries(20):
+        mortgage.delete()
+    assert not LedgerMonth.objects.exists()
+
+
+def test_ledger_invalidation_rollback(mortgage, transactional_db):
+    Ledger(mortgage=mortgage).calculate_cost()
+
+    with pytest.raises(ValueError):
+        with transaction.atomic():
+            Overpayment.objects.create(
+                mortgage=mortgage,
+                month=1,
+                date=add_months_to_date(mortgage.start_date, 1),
+                amount=Decimal("1.00"),
+            )
+            raise ValueError
+
+    # Which has nothing to do with what was rolled back.
+    overpayment = Overpayment.objects.filter(mortgage=mortgage).last()
+    months = LedgerMonth.objects.for_mortgage(mortgage)
+    before = dict(months.values_list("month_number", "pk"))
+    with transaction.atomic():
+        overpayment.amount += 1000
+        overpayment.save()
+
+    after = dict(months.values_list("month_number", "pk"))
+    assert all(
+        before[month] != after[month]
+        for month in range(overpayment.month, len(after))
+    )
+    expected = sum(
+        entry.interest + entry.discrepancy
+        for entry in calculate_reference(mortgage)
+    )
+    assert Ledger(mortgage=mortgage).calculate_cost() == expected
+
+
+def test_ledger_months(mortgage):
+    cost = Ledger(mortgage=mortgage).calculate_cost()
+
+    months = LedgerMonth.objects.for_mortgage(mortgage)
+    assert months.count() == len(calculate_reference(mortgage))
+    assert months.cost() == cost * 100
+    before = dict(months.values_list("month_number", "pk"))
+
+    form = AmountCreateUpdate(
+        data={"amount": "20000", "month": 30, "mortgage": mortgage.pk},
+        model=Overpayment,
+        user=mortgage.owner,
+    )
+    assert form.is_valid()
+    form.save()
+
+    after = dict(months.values_list("month_number", "pk"))
+    assert {month: before[month] for month in range(30)} == {
+        month: after[month] for month in range(30)
+    }
+    assert all(before.get(month) != after[month] for month in range(30, 40))
+
+    expected = calculate_reference(mortgage)
+    ledger = Ledger(mortgage=mortgage)
+    assert months.cost() == ledger.calculate_cost() * 100
+    assert ledger.ledger == expected
+
+
+def test_mortgage_summary(client, mortgage, transactional_db):
+    # Summaries are refreshed on commit, which needs real transactions.
+    overpayment = Overpayment.objects.get(mortgage=mortgage, month=30)
+    overpayment.amount = Decimal("20000")
+    overpayment.save()
+
+    expected = calculate_reference(mortgage)
+    mortgage.refresh_from_db()
+    assert mortgage.total_cost == sum(
+        entry.interest + entry.discrepancy for entry in expected
+    )
+    assert mortgage.total_interest == sum(entry.interest for entry in expected)
+    assert mortgage.payoff_date == datetime.date(
+        day=1,
+        **add_months(2020, 5, len(expected) - 1),
+    )
+
+    duplicate = Mortgage.objects.get(pk=mortgage.pk).duplicate()
+    Overpayment.objects.create(
+        mortgage=duplicate,
+        month=1,
+        amount=Decimal("50000"),
+    )
+
+    duplicate.refresh_from_db()
+    assert duplicate.payoff_date < mortgage.payoff_date
+
+    today = datetime.date.today()
+    next_month = (today.year - 2020) * 12 + today.month - 5 + 1
+    mortgage = Mortgage.objects.with_next_month_balance().get(pk=mortgage.pk)
+    if next_month < len(expected):
+        expected_balance = expected[next_month].opening_balance
+    else:
+        expected_balance = None
+    assert mortgage.next_month_balance == expected_balance
+
+    client.force_login(mortgage.owner)
+    response = client.get("/mortgages/?order=-payoff_date")
+    assert list(response.context["mortgage_list"]) == [mortgage, duplicate]
+    response = client.get("/mortgages/?order=payoff_date")
+    assert list(response.context["mortgage_list"]) == [duplicate, mortgage]
+
+    # As they were before summaries were kept.
+    Mortgage.objects.update(
+        payoff_date=None,
+        total_cost=None,
+        total_interest=None,
+    )
+    response = client.get("/mortgages/?order=payoff_date")
+    assert list(response.context["mortgage_list"]) == [duplicate, mortgage]
+    mortgage.refresh_from_db()
+    assert mortgage.total_interest == sum(entry.interest for entry in expected)
+
+
+def test_amount_dates(mortgage, django_assert_num_queries):
+    def average(mortgage):
+        return (
+            Overpayment.objects
+            .for_mortgage(mortgage)
+            .in_the_past()
+            .average()
+        )
+
+    assert average(mortgage) == Decimal("10255.55") / 4
+    assert average(mortgage) == (
+        Ledger(mortgage=mortgage).average_past_overpayment()
+    )
+
+    mortgage = Mortgage.objects.get(pk=mortgage.pk)
+    mortgage.start_date = datetime.date(2024, 1, 31)
+    mortgage.save()
+
+    def dates(mortgage):
+        return dict(
+            Overpayment.objects
+            .for_mortgage(mortgage)
+            .values_list("month", "date"),
+        )
+
+    # Clamped to the end of shorter months.
+    assert dates(mortgage)[3] == datetime.date(2024, 4, 30)
+
+    today = datetime.date.today()
+    mortgage.start_date = datetime.date(
+        day=1,
+        **add_months(today.year, today.month, -4),
+    )
+    mortgage.save()
+
+    assert dates(mortgage)[0] == mortgage.start_date
+    assert average(mortgage) == Decimal("250.55") / 2
+    assert average(mortgage) == (
+        Ledger(mortgage=mortgage).average_past_overpayment()
+    )
+
+    # Not when it hasn't moved: just the update, its ledger having been
+    # thrown away already in this transaction.
+    with django_assert_num_queries(1):
+        mortgage.save()
+
+
+def test_mortgage_duplicate(client, mortgage, django_assert_num_queries):
+    RateChange.objects.create(
+        mortgage=mortgage,
+        start_month=36,
+        interest_rate=Decimal("0.03000"),
+    )
+    ActualInitialPayment.objects.create(
+        mortgage=mortgage,
+        amount=Decimal("1000"),
+    )
+    Overpayment.objects.bulk_set(mortgage, {
+        month: Decimal("10") for month in range(100, 150)
+    })
+
+    def inputs(mortgage):
+        return sorted(
+            row[1:3] + row[4:]
+            for row in ledger_input_rows(mortgage=mortgage)
+        )
+
+    # The inputs, the copy (and locking it and its invalidation), then one
+    # for each kind of input however many of them there are, all within a
+    # savepoint.
+    mortgage = Mortgage.objects.get(pk=mortgage.pk)
+    with django_assert_num_queries(10):
+        duplicate = mortgage.duplicate()
+
+    assert duplicate.pk != mortgage.pk
+    assert inputs(duplicate) == inputs(mortgage)
+
+    for model in [Overpayment, Discrepancy]:
+        copied, original = (
+            {
+                month: (amount, date)
+                for month, amount, date in model.objects.for_mortgage(
+                    source,
+                ).values_list("month", "amount", "date")
+            }
+            for source in [duplicate, mortgage]
+        )
+        assert copied and copied == original
+
+    copied, original = Ledger(mortgage=duplicate), Ledger(mortgage=mortgage)
+    assert copied.calculate_cost() == original.calculate_cost()
+    assert copied.schedule.columns == original.schedule.columns
+
+    client.force_login(mortgage.owner)
+    url = f"/mortgages/{mortgage.pk}/duplicate/"
+    response = client.post(url, {
+        "vary": "interest_rate_thereafter",
+        "values": "0.03, 0.05",
+    })
+    assert response.status_code == 302
+    variants = Mortgage.objects.order_by("-pk")[:2]
+    assert [variant.interest_rate_thereafter for variant in variants] == [
+        Decimal("0.05"),
+        Decimal("0.03"),
+    ]
+    assert all(inputs(variant) == inputs(mortgage) for variant in variants)
+
+    response = client.post(url, {"vary": "term", "values": "120, 1.5"})
+    assert response.status_code == 200
+    assert response.context["form"].errors["values"]
+
+
+def test_query_budgets(
+    client,
+    mortgage,
+    shared_ledger_cache,
+    django_assert_num_queries,
+):
+    caching.get_cache().clear()
+    client.force_login(mortgage.owner)
+    Mortgage.objects.get(pk=mortgage.pk).duplicate()
+
+    # Session, user, mortgage and ledger inputs, then the stored months
+    # and storing the rest the first time, once the mortgage is locked and
+    # its `ledger_version` checked (in a savepoint, here).
+    with django_assert_num_queries(9):
+        response = client.get(f"/mortgages/{mortgage.pk}/")
+    assert response.context["average_overpayment"] == (
+        Decimal("10255.55") / 4
+    )
+
+    with django_assert_num_queries(4):
+        client.get(f"/mortgages/{mortgage.pk}/")
+
+    with django_assert_num_queries(4):
+        client.get(f"/mortgages/{mortgage.pk}/speculate/?amount=1&month=3")
+
+    # Without the pointer, all read back from the stored months, and so
+    # nothing locked.
+    caching.get_cache().clear()
+    with django_assert_num_queries(5):
+        client.get(f"/mortgages/{mortgage.pk}/")
+
+    # Once the summaries are refreshed, as they would've been on commit.
+    call_command("refreshsummaries")
+    with django_assert_num_queries(3):
+        response = client.get("/mortgages/")
+    assert len(response.context["mortgage_list"]) == 2
+
+
+LEDGER_ROWS_REFERENCE = """{% load get %}{% for entry in ledger %}
+      <tr>
+        {{ entry.as_tds }}
+        <td>
+          {% with what_could_have_been|get:forloop.counter0 as extra_cost %}
+            {% if extra_cost is not None %}
+              {% include "mortgages/_extra_cost.html" %}
+            {% endif %}
+          {% endwith %}
+        </td>
+      </tr>
+    {% endfor %}"""
+
+
+@pytest.mark.parametrize("thousand_separator", [False, True])
+def test_ledger_rows(mortgage, settings, thousand_separator):
+    settings.USE_THOUSAND_SEPARATOR = thousand_separator
+
+    ledger = Ledger(mortgage=mortgage)
+    what_could_have_been = ledger.costs_without_overpayments()
+
+    expected = engines["django"].from_string(LEDGER_ROWS_REFERENCE).render({
+        "ledger": ledger.ledger,
+        "what_could_have_been": what_could_have_been,
+    })
+    assert rendering.ledger_rows(ledger, what_could_have_been) == expected
+
+
+def without_csrf_tokens(html):
+    return re.sub(rb'name="csrfmiddlewaretoken" value="[^"]*"', b"", html)
+
+
+async def asgi_get(client, path):
+    """
+    `path`, through the ASGI application itself, as `client`'s user.
+    """
+    received = []
+    requests = [{"type": "http.request"}]
+
+    async def receive():
+        if requests:
+            return requests.pop()
+
+        # Then waits for the client to go, which it doesn't.
+        await asyncio.get_event_loop().create_future()
+
+    async def send(message):
+        received.append(message)
+
+    await application(
+        {
+            "type": "http",
+            "method": "GET",
+            "path": path,
+            "query_string": b"",
+            "headers": [
+                (b"host", b"testserver"),
+                (b"cookie", "; ".join(
+                    f"{name}={cookie.value}"
+                    for name, cookie in client.cookies.items()
+                ).encode()),
+            ],
+        },
+        receive,
+        send,
+    )
+
+    return b"".join(
+        message.get("body", b"")
+        for message in received
+        if message["type"] == "http.response.body"
+    )
+
+
+@pytest.fixture
+def asgi(transactional_db):
+    """
+    For requests through ASGI, where the views that calculate ledgers
+    use connections of their own, which can only see what's committed.
+    """
+    # Finishing a request closes the test's own connection, otherwise.
+    request_finished.disconnect(close_old_connections)
+    try:
+        yield
+    finally:
+        request_finished.connect(close_old_connections)
+
+
+def test_streamed_detail(client, mortgage, asgi):
+    client.force_login(mortgage.owner)
+    expected = client.get(f"/mortgages/{mortgage.pk}/").content
+
+    response = client.get(f"/mortgages/{mortgage.pk}/stream/")
+    assert response.streaming
+    chunks = list(response.streaming_content)
+    assert b"<h1>" in chunks[0] and b"Summary" not in chunks[0]
+    assert without_csrf_tokens(b"".join(chunks)) == (
+        without_csrf_tokens(expected)
+    )
+
+    # Which iterates the response away from the database.
+    content = async_to_sync(asgi_get)(
+        client,
+        f"/mortgages/{mortgage.pk}/stream/",
+    )
+    assert without_csrf_tokens(content) == without_csrf_tokens(expected)
+
+
+def test_streaming_iterate(db):
+    """
+    Using the database only to tidy up the connections of its threads.
+    """
+    threads = []
+    produced = []
+
+    def chunks():
+        for chunk in range(100):
+            threads.append(threading.get_ident())
+            produced.append(chunk)
+            time.sleep(0.002)
+            yield chunk
+
+    async def read(count, receive=None):
+        chunks_read = []
+        parts = streaming.iterate(chunks(), receive=receive, buffer=2)
+        try:
+            async for chunk in parts:
+                chunks_read.append(chunk)
+                if len(chunks_read) == count:
+                    break
+        finally:
+            await parts.aclose()
+
+        return chunks_read
+
+    assert async_to_sync(read)(None) == list(range(100))
+    assert threading.get_ident() not in threads
+
+    # Abandoned, it stops within the buffer of where it was read up to.
+    produced.clear()
+    assert async_to_sync(read)(3) == [0, 1, 2]
+    assert len(produced) <= 3 + 2 + 1
+
+    # As when the client goes.
+    produced.clear()
+    gone = asyncio.Event()
+
+    async def receive():
+        await gone.wait()
+
+        return {"type": "http.disconnect"}
+
+    async def read_until_gone():
+        async def go():
+            while len(produced) < 2:
+                await asyncio.sleep(0.01)
+
+            gone.set()
+
+        chunks, _ = await asyncio.gather(read(None, receive=receive), go())
+
+        return chunks
+
+    read_before_gone = async_to_sync(read_until_gone)()
+    assert len(read_before_gone) < 100
+    assert len(produced) <= len(read_before_gone) + 2 + 1
+
+
+def test_offloaded_views(client, mortgage, asgi, monkeypatch):
+    client.force_login(mortgage.owner)
+    caching.get_cache().clear()
+
+    calculating = threading.Event()
+    listed = threading.Event()
+    calculate = Ledger._calculate
+
+    def slow_calculate(self, *args, **kwargs):
+        calculating.set()
+        # The mortgage list has to be served meanwhile.
+        assert listed.wait(timeout=5)
+
+        return calculate(self, *args, **kwargs)
+
+    monkeypatch.setattr(Ledger, "_calculate", slow_calculate)
+
+    async def get_both():
+        async def get_list():
+            await asyncio.get_event_loop().run_in_executor(
+                None,
+                calculating.wait,
+                5,
+            )
+            content = await asgi_get(client, "/mortgages/")
+            listed.set()
+
+            return content
+
+        return await asyncio.gather(
+            asgi_get(client, f"/mortgages/{mortgage.pk}/"),
+            get_list(),
+        )
+
+    detail, listing = async_to_sync(get_both)()
+    assert calculating.is_set() and listed.is_set()
+    assert b"Total cost" in detail
+    assert str(mortgage).encode() in listing
+
+
+def test_server_timing(client, mortgage, settings):
+    client.force_login(mortgage.owner)
+    caching.get_cache().clear()
+    metrics.registry.clear()
+    overpayments = len(Ledger(mortgage=mortgage).overpayments)
+
+    response = client.get(f"/mortgages/{mortgage.pk}/")
+    timings = {
+        entry.split(";")[0]: dict(
+            parameter.split("=", 1)
+            for parameter in entry.split(";")[1:]
+        )
+        for entry in response["Server-Timing"].split(", ")
+    }
+    assert set(timings) == {
+        "db",
+        "ledger",
+        "counterfactuals",
+        "render",
+        "total",
+    }
+    assert int(timings["db"]["desc"].strip('"').split()[0]) > 0
+    assert timings["counterfactuals"]["desc"] == f'"{overpayments}"'
+    assert float(timings["ledger"]["dur"]) > 0
+    assert float(timings["render"]["dur"]) > 0
+    assert float(timings["total"]["dur"]) >= sum(
+        float(timings[name]["dur"]) for name in ["db", "ledger", "render"]
+    )
+    # As with Django's own templates.
+    assert "mortgages/mortgage_detail.html" in [
+        template.name for template in response.templates
+    ]
+    template = engines["django"].get_template("mortgages/mortgage_list.html")
+    assert template.origin.template_name == "mortgages/mortgage_list.html"
+    assert isinstance(template.template, Template)
+
+    client.get("/mortgages/")
+    assert client.get("/metrics").status_code == 403
+
+    settings.METRICS_TOKEN = "scrape"
+    assert client.get(
+        "/metrics",
+        HTTP_AUTHORIZATION="Bearer wrong",
+    ).status_code == 403
+    text = client.get(
+        "/metrics",
+        HTTP_AUTHORIZATION="Bearer scrape",
+    ).content.decode()
+    assert (
+        'msim_request_duration_seconds_count{view="mortgages:detail"} 1'
+        in text
+    )
+    assert (
+        'msim_request_duration_seconds_bucket{view="mortgages:list",le="+Inf"}'
+        ' 1' in text
+    )
+    assert (
+        f'msim_counterfactuals_total{{view="mortgages:detail"}} {overpayments}'
+        in text
+    )
+
+    settings.METRICS_TOKEN = ""
+    mortgage.owner.is_staff = True
+    mortgage.owner.save()
+    assert client.get("/metrics").status_code == 200
+
+
+def test_ledger_export(client, mortgage):
+    client.force_login(mortgage.owner)
+    expected = calculate_reference(mortgage)
+
+    response = client.get(f"/mortgages/{mortgage.pk}/ledger.csv")
+    assert response["Content-Type"] == "text/csv"
+    rows = list(csv.DictReader(
+        b"".join(response.streaming_content).decode().splitlines(),
+    ))
+    assert len(rows) == len(expected)
+    assert rows[3]["month"] == "2020-08"
+    assert [Decimal(row["closing_balance"]) for row in rows] == [
+        entry.closing_balance for entry in expected
+    ]
+
+    response = client.get(f"/mortgages/{mortgage.pk}/ledger.jsonl?gzip=1")
+    assert response["Content-Disposition"].endswith('.jsonl.gz"')
+    rows = [
+        json.loads(line)
+        for line in gzip.decompress(b"".join(response.streaming_content))
+        .decode()
+        .splitlines()
+    ]
+    assert [Decimal(row["interest"]) for row in rows] == [
+        entry.interest for entry in expected
+    ]
+
+
+def test_owner_ledger_export(client, mortgage, transactional_db):
+    # The rows are read in a thread of their own, which can only see
+    # what's been committed.
+    duplicate = Mortgage.objects.get(pk=mortgage.pk).duplicate()
+    Overpayment.objects.create(
+        mortgage=duplicate,
+        month=1,
+        amount=Decimal("50000"),
+    )
+
+    other = get_user_model().objects.create_user(username="other")
+    Mortgage.objects.get(pk=mortgage.pk).duplicate()
+    Mortgage.objects.exclude(pk__in=[mortgage.pk, duplicate.pk]).update(
+        owner=other,
+    )
+
+    client.force_login(mortgage.owner)
+    response = client.get("/mortgages/ledgers.csv")
+    rows = list(csv.DictReader(
+        b"".join(response.streaming_content).decode().splitlines(),
+    ))
+    assert [
+        (int(row["mortgage"]), row["closing_balance"]) for row in rows
+    ] == [
+        (owned.pk, str(entry.closing_balance))
+        for owned in [mortgage, duplicate]
+        for entry in calculate_reference(owned)
+    ]
+
+    client.force_login(other)
+    response = client.get("/mortgages/ledgers.jsonl")
+    rows = [
+        json.loads(line)
+        for line in b"".join(response.streaming_content).splitlines()
+    ]
+    assert len(rows) == len(calculate_reference(mortgage))
+    assert {row["mortgage"] for row in rows} == {
+        Mortgage.objects.get(owner=other).pk,
+    }
+
+
+def test_owner_ledger_export_queries(client, mortgage):
+    client.force_login(mortgage.owner)
+
+    def export_queries():
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get("/mortgages/ledgers.csv")
+            b"".join(response.streaming_content)
+
+        return len(queries)
+
+    one = export_queries()
+    for _ in range(3):
+        Mortgage.objects.get(pk=mortgage.pk).duplicate()
+
+    # The stored months of each, and nothing locked or stored.
+    assert export_queries() == one + 3
+    assert not LedgerMonth.objects.exclude(mortgage=mortgage).exists()
+
+
+def ledger_row_list(mortgage):
+    ledger = Ledger(mortgage=mortgage)
+
+    return list(rendering.iter_ledger_rows(
+        ledger,
+        ledger.iter_costs_without_overpayments(),
+        chunk_months=1,
+    ))
+
+
+def apply_ledger_diff(rows, diff):
+    """
+    What `applyLedgerDiff` in base.js does to the page.
+    """
+    rows = list(rows)
+    for month in reversed(diff["removed"]):
+        del rows[month]
+    for month, row in diff["rows"].items():
+        if int(month) < len(rows):
+            rows[int(month)] = row
+        else:
+            rows.append(row)
+
+    return rows
+
+
+def test_ledger_diff(client, mortgage):
+    client.force_login(mortgage.owner)
+
+    def check(url, data=None):
+        before = ledger_row_list(mortgage)
+        diff = client.post(url, data or {}).json()
+        after = ledger_row_list(mortgage)
+
+        assert apply_ledger_diff(before, diff) == after
+        assert len(diff["rows"]) < len(after)
+        assert diff["removed"] == list(range(len(after), len(before)))
+
+        ledger = Ledger(mortgage=mortgage)
+        assert diff["summary"] == rendering.summary(ledger)
+        assert diff["month_choices"] == [
+            list(choice) for choice in ledger.month_choices
+        ]
+
+        return diff
+
+    overpayments = f"/mortgages/{mortgage.pk}/overpayments/"
+    check(overpayments, {"amount": "20000", "month": 30})
+    # Paying it off sooner.
+    assert check(overpayments, {"amount": "40000", "month": 6})["removed"]
+    check(
+        f"/mortgages/{mortgage.pk}/discrepancies/",
+        {"amount": "-40000", "month": 50},
+    )
+
+    overpayment = Overpayment.objects.get(mortgage=mortgage, month=6)
+    check(f"/mortgages/overpayments/{overpayment.pk}/delete/")
+
+
+def test_amount_owners(client, mortgage):
+    overpayment = Overpayment.objects.filter(mortgage=mortgage).first()
+    discrepancy = Discrepancy.objects.filter(mortgage=mortgage).first()
+    amounts = [
+        (model, list(model.objects.values_list("month", "amount")))
+        for model in [Overpayment, Discrepancy]
+    ]
+    client.force_login(get_user_model().objects.create_user(username="x"))
+
+    for url, data in [
+        (
+            f"/mortgages/{mortgage.pk}/overpayments/",
+            {"amount": "20000", "month": 1},
+        ),
+        (
+            f"/mortgages/{mortgage.pk}/discrepancies/",
+            {"amount": "20000", "month": 1},
+        ),
+        (f"/mortgages/overpayments/{overpayment.pk}/delete/", {}),
+        (f"/mortgages/discrepancies/{discrepancy.pk}/delete/", {}),
+    ]:
+        response = client.post(url, data)
+        assert response.status_code == 404
+        assert b"ledger" not in response.content.lower()
+
+    for url in [
+        f"/mortgages/{mortgage.pk}/overpayments/bulk/",
+        f"/mortgages/{mortgage.pk}/discrepancies/bulk/",
+    ]:
+        response = client.post(
+            url,
+            json.dumps({"1": "20000"}),
+            content_type="application/json",
+        )
+        assert response.status_code == 404
+
+    assert amounts == [
+        (model, list(model.objects.values_list("month", "amount")))
+        for model in [Overpayment, Discrepancy]
+    ]
+
+
+def test_amount_bulk_set(
+    client,
+    mortgage,
+    shared_ledger_cache,
+    django_assert_max_num_queries,
+):
+    client.force_login(mortgage.owner)
+    url = f"/mortgages/{mortgage.pk}/overpayments/bulk/"
+
+    def post(amounts):
+        return client.post(
+            url,
+            json.dumps(amounts),
+            content_type="application/json",
+        )
+
+    before = ledger_row_list(mortgage)
+    existing = dict(
+        Overpayment.objects
+        .for_mortgage(mortgage)
+        .values_list("month", "pk"),
+    )
+    deleted = min(existing)
+    amounts = {
+        **{month: "100.00" for month in range(24, 36)},
+        max(existing): "123.45",
+        deleted: None,
+    }
+
+    # However many months there are: two to delete amounts, one each to
+    # find, update and insert them, the rest as for any other edit,
+    # including storing the new ledger.
+    with django_assert_max_num_queries(19):
+        diff = post(amounts).json()
+
+    assert apply_ledger_diff(before, diff) == ledger_row_list(mortgage)
+    overpayments = dict(
+        Overpayment.objects
+        .for_mortgage(mortgage)
+        .values_list("month", "amount"),
+    )
+    assert deleted not in overpayments
+    assert overpayments[max(existing)] == Decimal("123.45")
+    assert Overpayment.objects.get(month=max(existing)).pk == (
+        existing[max(existing)]
+    )
+    assert all(
+        overpayments[month] == Decimal("100.00") for month in range(24, 36)
+    )
+
+    response = post({"-1": "1", "2": "lots"})
+    assert response.status_code == 400
+    assert len(response.json()["amounts"]) == 2
+
+    other = get_user_model().objects.create_user(username="other")
+    client.force_login(other)
+    assert post({"1": "1"}).status_code == 404
+
+
+def test_amount_bulk_set_invalidates(mortgage):
+    Ledger(mortgage=mortgage).calculate_cost()
+
+    # Updating, deleting and creating, only the deleting sending signals.
+    Overpayment.objects.bulk_set(mortgage, {
+        3: Decimal("500"),
+        30: None,
+        60: Decimal("100"),
+    })
+
+    expected = sum(
+        entry.interest + entry.discrepancy
+        for entry in calculate_reference(mortgage)
+    )
+    mortgage = Mortgage.objects.get(pk=mortgage.pk)
+    assert Ledger(mortgage=mortgage).calculate_cost() == expected
+    assert LedgerMonth.objects.for_mortgage(mortgage).cost() == expected * 100
+
+
+def test_jobs(client, mortgage, monkeypatch):
+    client.force_login(mortgage.owner)
+    url = f"/mortgages/{mortgage.pk}/jobs/speculation_grid/"
+
+    response = client.post(url, {"amounts": "100, 500"})
+    assert response.status_code == 202
+    job = response.json()
+    assert job["status"] == "pending"
+    assert client.post(url, {"amounts": "100, 500"}).json()["id"] == job["id"]
+
+    call_command("runjobs", "--once")
+
+    job = client.get(job["url"]).json()
+    assert job["status"] == "done"
+    assert job["progress"] == 1
+    ledger = Ledger(mortgage=mortgage)
+    assert {
+        (Decimal(cell["amount"]), cell["month"]): (
+            Decimal(cell["cost"]),
+            cell["no_money"],
+        )
+        for cell in job["result"]
+    } == ledger.speculation_grid(
+        amounts=[Decimal("100"), Decimal("500")],
+        months=[month for month, _ in ledger.month_choices],
+    )
+
+    # Reused until something it depends on changes.
+    response = client.post(url, {"amounts": "100, 500"})
+    assert response.status_code == 200
+    assert response.json()["id"] == job["id"]
+    Overpayment.objects.create(
+        mortgage=mortgage,
+        month=10,
+        amount=Decimal("1"),
+    )
+    assert client.post(url, {"amounts": "100, 500"}).json()["id"] != (
+        job["id"]
+    )
+
+    def explode(self):
+        raise ValueError("kaboom")
+
+    monkeypatch.setattr(Ledger, "iter_costs_without_overpayments", explode)
+    job = client.post(
+        f"/mortgages/{mortgage.pk}/jobs/costs_without_overpayments/",
+    ).json()
+    call_command("runjobs", "--once")
+    job = client.get(job["url"]).json()
+    assert job["status"] == "failed"
+    assert "kaboom" in job["error"]
+
+    assert client.post(url, {"amounts": "lots"}).status_code == 400
+    for drift, volatility in [("0.2", "0.005"), ("0", "1")]:
+        assert client.post(
+            f"/mortgages/{mortgage.pk}/jobs/simulate_rates/",
+            {"paths": 1, "drift": drift, "volatility": volatility, "seed": 0},
+        ).status_code == 400
+    assert client.post(
+        f"/mortgages/{mortgage.pk}/jobs/nonsense/",
+    ).status_code == 404
+
+    client.force_login(get_user_model().objects.create_user(username="x"))
+    assert client.get(job["url"]).status_code == 404
+    assert client.post(url, {"amounts": "1"}).status_code == 404
+
+
+def test_job_kinds(client, mortgage):
+    client.force_login(mortgage.owner)
+    submitted = {
+        "speculation_grid": {"amounts": "100, 500"},
+        "costs_without_overpayments": {},
+        "costs_without_discrepancies": {},
+        "simulate_rates": {
+            "paths": "20",
+            "drift": "0",
+            "volatility": "0.005",
+            "seed": "1",
+        },
+        "optimise": {"budget": "10000"},
+    }
+    assert set(submitted) == set(jobs.KINDS)
+
+    urls = {
+        kind: client.post(
+            f"/mortgages/{mortgage.pk}/jobs/{kind}/",
+            data,
+        ).json()["url"]
+        for kind, data in submitted.items()
+    }
+    call_command("runjobs", "--once")
+    results = {}
+    for kind, url in urls.items():
+        job = client.get(url).json()
+        assert (job["status"], job["error"]) == ("done", "")
+        results[kind] = job["result"]
+
+    def encoded(value):
+        return json.loads(json.dumps(value, cls=DjangoJSONEncoder))
+
+    ledger = Ledger(mortgage=mortgage)
+    assert len(results["speculation_grid"]) == 2 * len(ledger.month_choices)
+    assert results["costs_without_overpayments"] == encoded([
+        {"month": month, "cost": cost}
+        for month, cost in ledger.costs_without_overpayments().items()
+    ])
+    assert results["costs_without_discrepancies"] == encoded([
+        {"month": month, "cost": cost}
+        for month, cost in ledger.costs_without_discrepancies().items()
+    ])
+    assert results["costs_without_discrepancies"]
+    assert results["simulate_rates"] == encoded(ledger.simulate_rates(
+        paths=20,
+        drift=0.0,
+        volatility=0.005,
+        seed=1,
+    ))
+    overpayments, cost = ledger.optimise_overpayments(Decimal("10000"))
+    assert results["optimise"]["cost"] == encoded(cost)
+    assert len(results["optimise"]["overpayments"]) == len(overpayments)
+
+
+def test_stale_jobs(mortgage, settings):
+    job = jobs.submit(mortgage, "costs_without_overpayments", {})
+    assert Job.objects.claim() == job
+    assert Job.objects.claim() is None
+    assert jobs.submit(mortgage, "costs_without_overpayments", {}) == job
+
+    # As if its worker had died.
+    Job.objects.filter(pk=job.pk).update(
+        started=timezone.now() - datetime.timedelta(
+            seconds=settings.JOB_TIMEOUT + 1,
+        ),
+    )
+    assert jobs.submit(mortgage, "costs_without_overpayments", {}) == job
+    call_command("runjobs", "--once")
+    job.refresh_from_db()
+    assert job.status == Job.DONE
+
+
+def speculate_reference(mortgage, amount, month):
+    """
+    `Speculate`, as it was before `Ledger.speculate`.
+    """
+    ledger = Ledger(mortgage=mortgage)
+    base_cost = ledger.calculate_cost()
+    speculation = Ledger(mortgage=mortgage)
+
+    no_money = False
+    remaining = amount
+    while remaining > 0:
+        overpayment = ledger.ledger[month].overpayment
+        speculation.set_overpayment(
+            month,
+            Overpayment(amount=max(overpayment - remaining, 0)),
+        )
+        remaining -= overpayment
+        month -= 1
+
+        if month < 0:
+            no_money = True
+
+            break
+
+    return base_cost - speculation.calculate_cost() + amount, no_money
+
+
+def test_ledger_speculation_grid(mortgage):
+    amounts = [Decimal("0"), Decimal("100"), Decimal("5000"), Decimal("1e5")]
+    months = [0, 1, 3, 29, 30, 31, 50, 106]
+
+    grid = Ledger(mortgage=mortgage).speculation_grid(amounts, months)
+
+    assert grid == {
+        (amount, month): speculate_reference(mortgage, amount, month)
+        for amount in amounts
+        for month in months
+    }
+
+
+def test_speculate_grid_view(client, mortgage):
+    client.force_login(mortgage.owner)
+
+    response = client.get(
+        f"/mortgages/{mortgage.pk}/speculate/grid/",
+        {"amounts": "100, 5000"},
+    )
+
+    assert response.status_code == 200
+    assert len(response.context["rows"]) == len(
+        calculate_reference(mortgage),
+    )
+
+    for amounts in [
+        "NaN",
+        "100, Infinity",
+        "1.001",
+        "1e10",
+        ", ".join(str(amount) for amount in range(21)),
+    ]:
+        response = client.get(
+            f"/mortgages/{mortgage.pk}/speculate/grid/",
+            {"amounts": amounts},
+        )
+
+        assert response.status_code == 200
+        assert not response.context["valid"]
+        assert response.context["form"].errors["amounts"]
+
+
+def test_ledger_optimise_overpayments(mortgage):
+    # Leaving some disposable income to spend.
+    mortgage.default_overpayment_initial = Decimal("100.00")
+    mortgage.default_overpayment_thereafter = Decimal("200.00")
+    mortgage.save()
+
+    budget = Decimal("10000")
+    ledger = Ledger(mortgage=mortgage)
+    current_cost = ledger.calculate_cost()
+    planned = {
+        entry.month_number: entry.overpayment
+        for entry in ledger.ledger
+    }
+    overpayments, cost = ledger.optimise_overpayments(budget)
+
+    periods = mortgage.as_periods()
+    caps = {
+        period.start_month: mortgage.disposable_income - period.payment
+        for period in periods.periods
+    }
+    assert sum(
+        overpayment - planned[month]
+        for month, overpayment in overpayments.items()
+    ) == budget
+    assert all(
+        planned[month] < overpayment
+        <= caps[periods.get_period(month).start_month]
+        for month, overpayment in overpayments.items()
+    )
+
+    def cost_of(overpayments):
+        ledger = Ledger(mortgage=mortgage)
+        for month, amount in overpayments.items():
+            ledger.set_overpayment(month, Overpayment(amount=amount))
+
+        return ledger.calculate_cost()
+
+    # What applying them gives, everything else as planned.
+    assert cost_of(overpayments) == cost
+    assert cost > current_cost
+
+    # Any other way of spending the same budget on top of the plan, within
+    # the same caps, is no cheaper.
+    later = {
+        month + 6: planned[month + 6] + overpayment - planned[month]
+        for month, overpayment in overpayments.items()
+    }
+    spread = {
+        month: planned[month] + min(
+            budget / 100,
+            caps[periods.get_period(month).start_month] - planned[month],
+        )
+        for month in range(100)
+        if planned[month] < caps[periods.get_period(month).start_month]
+    }
+    assert cost > cost_of(later)
+    assert cost > cost_of(spread)
+
+
+def test_ledger_simulate_rates(mortgage):
+    ledger = Ledger(mortgage=mortgage)
+    cost = ledger.calculate_cost()
+    last = calculate_reference(mortgage)[-1]
+
+    steady = ledger.simulate_rates(
+        paths=10,
+        drift=0,
+        volatility=0,
+        seed=1,
+        workers=1,
+    )
+    assert steady["unpaid"] == 0
+    assert set(steady["costs"].values()) == {cost}
+    assert set(steady["payoffs"].values()) == {last.month_name}
+
+    kwargs = {"paths": 1200, "drift": 0.001, "volatility": 0.01, "seed": 1}
+    assert ledger.simulate_rates(workers=1, **kwargs) == (
+        ledger.simulate_rates(workers=2, **kwargs)
+    )
+
+    # The same processes, however many times it's run.
+    started = montecarlo.get_executor.cache_info().misses
+    ledger.simulate_rates(workers=2, **kwargs)
+    ledger.simulate_rates(workers=100, **kwargs)
+    assert montecarlo.get_executor.cache_info().misses == started